@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import argparse
+import collections
+from visualizer import Visualizer, loadTranscript
+
+def timestampMinutes(timestamp):
+    """
+    Converts a transcript timestamp ('mm:ss', minutes may exceed 59 e.g. '110:53', or 'h:mm:ss') to minutes
+
+    :param timestamp: the timestamp
+    :type timestamp: str
+
+    :rtype: float
+    :returns: minutes since the start of the transcript
+    """
+    seconds = 0
+    for part in timestamp.strip().split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds / 60
+
+
+def createJobs(paths_to_transcripts, start_timestamp=None, num_segments=None, split=None):
+    """
+    Creates one job per transcript, or per range of split segments when split is given
+
+    :param paths_to_transcripts: the transcript files
+    :type paths_to_transcripts: list of str
+
+    :param start_timestamp: timestamp to start each transcript from (transcripts without it start from the beginning)
+    :type start_timestamp: str
+
+    :param num_segments: maximum number of segments processed per transcript, None for all
+    :type num_segments: int
+
+    :param split: number of segments per job, None for one job per transcript
+    :type split: int
+
+    :rtype: list of dict
+    :returns: jobs with the transcript path, name and the [start_idx, end_idx) segment range
+    """
+    jobs = []
+    for path_to_transcript in paths_to_transcripts:
+        text, timestamps = loadTranscript(path_to_transcript)
+        start_idx = timestamps.index(start_timestamp) if start_timestamp in timestamps else 0
+        end_idx = len(text) if num_segments is None else min(len(text), start_idx + num_segments)
+        name = os.path.splitext(os.path.basename(path_to_transcript))[0]
+        step = split if split else max(1, end_idx - start_idx)
+        for range_start in range(start_idx, end_idx, step):
+            range_end = min(end_idx, range_start + step)
+            jobs.append({'path': path_to_transcript,
+                         'name': name if not split else name + '_' + str(range_start) + '-' + str(range_end),
+                         'start_idx': range_start,
+                         'end_idx': range_end})
+    return jobs
+
+
+def startJob(job, out_dir, searcher, encoder):
+    """
+    Loads the segments of a job and creates its visualizer
+
+    :param job: a job from createJobs
+    :type job: dict
+
+    :param out_dir: the batch output directory, the job writes to out_dir/<job name>/
+    :type out_dir: str
+
+    :param searcher: the shared pyserini SimpleSearcher
+    :type searcher: pyserini SimpleSearcher
+
+    :param encoder: the shared semantic encoder
+    :type encoder: SentenceTransformer
+
+    :rtype: dict
+    :returns: the state of the job
+    """
+    job_dir = os.path.join(out_dir, job['name']) + '/'
+    os.makedirs(job_dir, exist_ok=True)
+    text, timestamps = loadTranscript(job['path'])
+    # the job covers the time up to the next segment (the start of the next split), or up to its last segment
+    end_time = timestamps[job['end_idx']] if job['end_idx'] < len(timestamps) else timestamps[job['end_idx'] - 1]
+    minutes = timestampMinutes(end_time) - timestampMinutes(timestamps[job['start_idx']]) if job['end_idx'] > job['start_idx'] else 0
+    return {'job': job,
+            'visualizer': Visualizer(job_dir, None, searcher=searcher, encoder=encoder),
+            'text': text[job['start_idx']:job['end_idx']],
+            'timestamps': timestamps[job['start_idx']:job['end_idx']],
+            'position': 0,
+            'transcript_minutes': minutes,
+            'start': time.perf_counter()}
+
+
+def finishJob(state, topn=100, plot_docs=10):
+    """
+    Writes the history, frequent docs, rank plot, mean rank animation frames and projector export of a finished job
+
+    :param state: the state from startJob, after all its segments were added
+    :type state: dict
+
+    :param topn: number of frequent documents kept
+    :type topn: int
+
+    :param plot_docs: number of the most frequent documents plotted
+    :type plot_docs: int
+
+    :rtype: dict
+    :returns: stats of the job (segments, transcript minutes, seconds)
+    """
+    x = state['visualizer']
+    with open(x.out_dir + 'history.json', 'w') as f:
+        json.dump({'transcript_time': x.transcript_time, 'history': x.history}, f)
+    docs = x.findFreqDocs(0, len(x.history), topn=topn)
+    with open(x.out_dir + 'docs.json', 'w') as f:
+        for doc in docs:
+            f.write(x.searcher.doc(doc).raw())
+    x.getTimeline().exportMeanRankAnimation(x.out_dir + 'mean_rank_frames.json', topn=topn, labels=x.transcript_time)
+    if len(x.history) > 1:
+        x.plotDocRankings(0, len(x.history) - 1, docs[:plot_docs])
+        x.caterpillarEncode(0, len(x.history) - 1, docs)
+    return {'name': state['job']['name'],
+            'segments': len(state['text']),
+            'transcript_minutes': state['transcript_minutes'],
+            'seconds': time.perf_counter() - state['start']}
+
+
+def runBatch(jobs, out_dir, pyserini_index_path, max_active=32, threads=4, topn=100):
+    """
+    Processes the jobs with one shared searcher (one JVM) and one encoder.
+    Up to max_active jobs advance together, one transcript segment per round: the new segments of all
+    active jobs are searched with a single batch_search, which runs on threads inside the JVM.
+    Everything that calls into Java stays on this thread, the concurrency is on the Java side.
+    Writes out_dir/batch_report.json with the throughput in transcript minutes per wall clock minute.
+
+    :param jobs: jobs from createJobs
+    :type jobs: list of dict
+
+    :param out_dir: the batch output directory
+    :type out_dir: str
+
+    :param pyserini_index_path: path to the pyserini index
+    :type pyserini_index_path: str
+
+    :param max_active: number of jobs in progress at the same time (queries per batch_search)
+    :type max_active: int
+
+    :param threads: number of search threads of batch_search
+    :type threads: int
+
+    :param topn: number of frequent documents kept per job
+    :type topn: int
+
+    :rtype: dict
+    :returns: the report
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # loads the searcher and encoder once, every job's visualizer reuses them
+    shared = Visualizer(out_dir, pyserini_index_path)
+
+    start = time.perf_counter()
+    search_seconds = 0
+    pending = collections.deque(jobs)
+    active = []
+    results = []
+    failed = []
+    while pending or active:
+        while pending and len(active) < max_active:
+            job = pending.popleft()
+            try:
+                active.append(startJob(job, out_dir, shared.searcher, shared.encoder))
+            except Exception as e:
+                print('failed', job['name'], repr(e))
+                failed.append({'name': job['name'], 'error': repr(e)})
+
+        for state in [state for state in active if state['position'] == len(state['text'])]:
+            active.remove(state)
+            try:
+                results.append(finishJob(state, topn=topn))
+            except Exception as e:
+                print('failed', state['job']['name'], repr(e))
+                failed.append({'name': state['job']['name'], 'error': repr(e)})
+                continue
+            elapsed = time.perf_counter() - start
+            print(len(results) + len(failed), 'of', len(jobs), 'jobs done,', state['job']['name'], '-',
+                  round(sum(r['transcript_minutes'] for r in results) / (elapsed / 60), 1), 'transcript minutes per minute')
+        if not active:
+            continue
+
+        # the next segment of every active job, searched in one multi-threaded batch
+        qids = [str(i) for i in range(len(active))]
+        search_start = time.perf_counter()
+        hits = shared.searcher.batch_search([state['text'][state['position']] for state in active], qids,
+                                            k=shared.window_depth, threads=threads)
+        search_seconds += time.perf_counter() - search_start
+        for qid, state in zip(qids, active):
+            state['visualizer'].addToTranscript(state['text'][state['position']], timestamp=state['timestamps'][state['position']],
+                                                hits=[(hit.docid, hit.score) for hit in hits[qid]])
+            state['position'] += 1
+
+    wall_seconds = time.perf_counter() - start
+    transcript_minutes = sum(r['transcript_minutes'] for r in results)
+    report = {'jobs': sorted(results, key=lambda r: r['name']),
+              'failed': failed,
+              'max_active': max_active,
+              'threads': threads,
+              'wall_seconds': wall_seconds,
+              'search_seconds': search_seconds,
+              'transcript_minutes': transcript_minutes,
+              'transcript_minutes_per_minute': transcript_minutes / (wall_seconds / 60) if wall_seconds else 0}
+    with open(os.path.join(out_dir, 'batch_report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    print(round(transcript_minutes, 1), 'transcript minutes in', round(wall_seconds / 60, 2), 'minutes:',
+          round(report['transcript_minutes_per_minute'], 1), 'transcript minutes per minute,',
+          round(search_seconds, 1), 's searching with', threads, 'threads')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the visualizer over many transcripts (or time ranges), batching their searches')
+    parser.add_argument('transcripts', nargs='+', help='transcript files (alternating timestamp and text lines)')
+    parser.add_argument('--index', default='out/pyserini/index/', help='pyserini index directory')
+    parser.add_argument('--out', default='out/visualization/batch/', help='output directory, one subdirectory per job')
+    parser.add_argument('--start', default=None, help='timestamp to start each transcript from, e.g. 110:53')
+    parser.add_argument('--segments', type=int, default=None, help='maximum number of segments per transcript')
+    parser.add_argument('--split', type=int, default=None, help='segments per job, to process time ranges of a transcript together')
+    parser.add_argument('--active', type=int, default=32, help='jobs in progress at once, i.e. queries per batch_search')
+    parser.add_argument('--threads', type=int, default=4, help='search threads of batch_search')
+    parser.add_argument('--topn', type=int, default=100)
+    args = parser.parse_args()
+
+    jobs = createJobs(args.transcripts, start_timestamp=args.start, num_segments=args.segments, split=args.split)
+    runBatch(jobs, args.out, args.index, max_active=args.active, threads=args.threads, topn=args.topn)
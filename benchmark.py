@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import pickle
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import collections
+import numpy as np
+
+import initializer
+import processor
+import searcher
+import reranker
+import docstore
+import timeline
+
+# A small synthetic vocabulary, words are drawn from it with a zipfian distribution like real text
+VOCABULARY = ['the', 'of', 'and', 'to', 'a', 'in', 'is', 'that', 'it', 'for', 'not', 'be', 'this', 'are', 'as',
+              'god', 'universe', 'creation', 'time', 'evidence', 'argument', 'debate', 'rights', 'government',
+              'people', 'law', 'freedom', 'science', 'religion', 'abortion', 'life', 'death', 'penalty', 'school',
+              'education', 'economy', 'tax', 'health', 'care', 'energy', 'climate', 'nuclear', 'war', 'peace',
+              'marriage', 'equality', 'gun', 'control', 'drug', 'policy', 'animal', 'testing', 'internet', 'privacy',
+              'vaccine', 'immigration', 'border', 'minimum', 'wage', 'speech', 'vote', 'democracy', 'moral', 'truth']
+
+class HashingEncoder:
+    """
+    Stand-in for the SentenceTransformer encoder: hashed bag of words, L2 normalized.
+    Deterministic and needs no model download, so benchmarks run offline.
+    """
+
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        encoded = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for i, sentence in enumerate(sentences):
+            for word in sentence.lower().split():
+                bucket = int(hashlib.md5(word.encode()).hexdigest()[:8], 16)
+                encoded[i, bucket % self.dim] += 1.0 if bucket & 1 else -1.0
+        norms = np.linalg.norm(encoded, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return encoded / norms
+
+
+class Hit:
+    def __init__(self, docid, score):
+        self.docid = docid
+        self.score = score
+
+
+class InMemoryBM25:
+    """
+    Stand-in for the pyserini SimpleSearcher (set_bm25, search, batch_search), so bm25Search
+    can be benchmarked without a JVM or a Lucene index
+    """
+
+    def __init__(self, documents):
+        """
+        :param documents: dict of docid to document text
+        :type documents: dict
+        """
+        self.k1 = 0.9
+        self.b = 0.4
+        self.postings = collections.defaultdict(list)
+        self.doc_lengths = {}
+        for docid, text in documents.items():
+            terms = collections.Counter(text.lower().split())
+            self.doc_lengths[docid] = sum(terms.values())
+            for term, tf in terms.items():
+                self.postings[term].append((docid, tf))
+        self.avg_length = sum(self.doc_lengths.values()) / max(1, len(self.doc_lengths))
+
+    def set_bm25(self, k1=0.9, b=0.4):
+        self.k1 = k1
+        self.b = b
+
+    def search(self, query, k=10):
+        scores = collections.defaultdict(float)
+        for term in set(query.lower().split()):
+            postings = self.postings.get(term, [])
+            idf = math.log(1 + (len(self.doc_lengths) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for docid, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docid] / self.avg_length)
+                scores[docid] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+        return [Hit(docid, score) for docid, score in ranked]
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        return {qid: self.search(query, k) for query, qid in zip(queries, qids)}
+
+
+def generateText(rng, num_sentences):
+    """
+    Random argument-like text made of sentences of 6 to 30 words
+    """
+    weights = [1.0 / (rank + 1) for rank in range(len(VOCABULARY))]
+    sentences = []
+    for _ in range(num_sentences):
+        words = rng.choices(VOCABULARY, weights=weights, k=rng.randint(6, 30))
+        sentences.append(' '.join(words).capitalize() + '.')
+    return ' '.join(sentences)
+
+
+def generateCorpus(path_to_corpus_dir, num_docs, num_files=4, seed=0):
+    """
+    Writes a synthetic corpus in the args.me json layout that the initializer reads
+
+    :param path_to_corpus_dir: directory the json files are written to
+    :type path_to_corpus_dir: str
+
+    :param num_docs: total number of arguments
+    :type num_docs: int
+
+    :param num_files: number of json files the arguments are spread over
+    :type num_files: int
+
+    :param seed: random seed, the same seed always gives the same corpus
+    :type seed: int
+
+    :rtype: dict
+    :returns: dict of docid to document text
+    """
+    rng = random.Random(seed)
+    os.makedirs(path_to_corpus_dir, exist_ok=True)
+    documents = {}
+    for file_num in range(num_files):
+        arguments = []
+        for _ in range(file_num, num_docs, num_files):
+            docid = 'S%08x-A%08x' % (rng.getrandbits(32), rng.getrandbits(32))
+            premises = [{'text': generateText(rng, rng.randint(2, 25)), 'stance': rng.choice(['PRO', 'CON']), 'annotations': []}]
+            arguments.append({'id': docid,
+                              'conclusion': generateText(rng, 1),
+                              'premises': premises,
+                              'context': {'sourceId': docid.split('-')[0], 'sourceTitle': generateText(rng, 1)}})
+            documents[docid] = premises[0]['text']
+        with open(os.path.join(path_to_corpus_dir, 'synthetic' + str(file_num) + '.json'), 'w') as f:
+            json.dump({'arguments': arguments}, f)
+    return documents
+
+
+def generateTopics(num_topics, seed=0):
+    """
+    Synthetic topics in the same dict layout as processor.load_topics
+    """
+    rng = random.Random(seed)
+    return {str(i + 1): {'title': ' '.join(rng.sample(VOCABULARY[15:], 5)) + '?'} for i in range(num_topics)}
+
+
+# number of times every stage is run, the median wall time is reported
+REPEATS = 5
+
+def timed(results, name, func, *args, **kwargs):
+    """
+    Runs func REPEATS times, stores the median wall time in results[name]
+    (and every time in results['samples'][name]) and returns the result of the last run
+    """
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    results[name] = float(np.median(times))
+    results.setdefault('samples', {})[name] = times
+    return result
+
+
+def benchmarkScale(num_docs, workdir, num_topics=50, num_workers=1, seed=0):
+    """
+    Times every pipeline stage on a synthetic corpus of num_docs arguments
+
+    :param num_docs: number of arguments in the corpus
+    :type num_docs: int
+
+    :param workdir: scratch directory for the corpus, index and runs
+    :type workdir: str
+
+    :param num_topics: number of synthetic topics searched
+    :type num_topics: int
+
+    :param num_workers: number of encoder processes used to build the index
+    :type num_workers: int
+
+    :rtype: dict
+    :returns: dict of stage name to seconds, plus the corpus sizes
+    """
+    import hnswlib
+    from visualizer import Visualizer
+
+    results = {}
+    path_to_corpus_dir = os.path.join(workdir, 'corpus') + '/'
+    path_to_semantic_output = os.path.join(workdir, 'semantic') + '/'
+    path_to_run_output = os.path.join(workdir, 'runs') + '/'
+    for path in [path_to_semantic_output, path_to_run_output]:
+        os.makedirs(path, exist_ok=True)
+
+    documents = timed(results, 'generateCorpus', generateCorpus, path_to_corpus_dir, num_docs, seed=seed)
+    topics = generateTopics(num_topics, seed=seed)
+    model = HashingEncoder()
+
+    # passage creation on its own, then the full index build (which repeats it)
+    passages = timed(results, 'createSentences+createPassages',
+                     lambda: [processor.createPassages(processor.createSentences(text)) for text in documents.values()])
+    num_passages = sum(len(doc_passages) for doc_passages in passages)
+    timed(results, 'initializeSemantic', initializer.initializeSemantic, path_to_corpus_dir, path_to_semantic_output, model,
+          num_workers=num_workers, max_elements=max(1, num_passages))
+
+    def loadIndex():
+        index = hnswlib.Index(space = 'cosine', dim=768)
+        index.load_index(path_to_semantic_output + 'passage.index')
+        return index
+    index = timed(results, 'loadIndex', loadIndex)
+    index.set_ef(1100)
+    idx_to_docid = pickle.load(open(path_to_semantic_output + 'idx_to_passageid.p', 'rb'))
+    idx_to_passage = docstore.loadPassageStore(path_to_semantic_output + 'idx_to_passage')
+    docid_to_doc = timed(results, 'docid_to_doc', docstore.LazyDocMap, idx_to_docid, idx_to_passage)
+
+    k = min(1000, len(idx_to_docid))
+    semantic_run = timed(results, 'semanticSearch', searcher.semanticSearch, model, topics, index, idx_to_docid, k=k)
+    bm25_searcher = timed(results, 'bm25IndexBuild', InMemoryBM25, documents)
+    bm25_run = timed(results, 'bm25Search', searcher.bm25Search, bm25_searcher, topics)
+
+    timed(results, 'writeRelevanceFile', processor.writeRelevanceFile, bm25_run, path_to_run_output + 'run.bm25', 'bm25')
+    processor.writeRelevanceFile(semantic_run, path_to_run_output + 'run.semantic', 'semantic')
+    timed(results, 'loadRun', reranker.loadRun, path_to_run_output + 'run.bm25')
+    timed(results, 'writeRelevanceFile(binary)', processor.writeRelevanceFile, bm25_run, path_to_run_output + 'run.bm25.bin', 'bm25', binary=True)
+    # every topic is built, like the full parse of the text run
+    timed(results, 'loadRun(binary)', lambda: dict(reranker.loadRun(path_to_run_output + 'run.bm25.bin').items()))
+    interpolated = timed(results, 'interpolate', reranker.interpolate, path_to_run_output + 'run.bm25', path_to_run_output + 'run.semantic', 0.7)
+    processor.writeRelevanceFile(interpolated, path_to_run_output + 'run.bm25.semantic', 'bm25-0.7semantic')
+    timed(results, 'nn_pf_manifold', reranker.nn_pf_manifold, path_to_run_output + 'run.bm25.semantic', model, topics,
+          index, idx_to_docid, docid_to_doc, k=min(50, len(idx_to_docid)))
+
+    # compareRuns over consecutive topics, shaped like the visualizer history
+    history = [{'dcg': 0, 'docs': {doc[0]: {'counter': 0, 'position': i, 'position_change': 0, 'score': doc[1], 'score_change': doc[1]}
+                                   for i, doc in enumerate(bm25_run[topic][:100])}} for topic in topics]
+    def compareAll():
+        for prev_run, cur_run in zip(history, history[1:]):
+            Visualizer.compareRuns(prev_run, cur_run)
+    timed(results, 'compareRuns', compareAll)
+    timed(results, 'timelineBuild', lambda: timeline.Timeline(history).build())
+    history_timeline = timeline.Timeline(history)
+    timed(results, 'findFreqDocs', lambda: [history_timeline.freqDocs(start, start + 10, topn=100) for start in range(len(history))])
+
+    results['num_docs'] = num_docs
+    results['num_passages'] = num_passages
+    results['num_topics'] = num_topics
+    return results
+
+
+def runBenchmarks(scales, path_to_output, num_topics=50, num_workers=1, seed=0, workdir=None, repeats=5):
+    """
+    Runs benchmarkScale for every scale and writes the results to a json file
+
+    :param scales: corpus sizes (number of arguments) to benchmark
+    :type scales: list of int
+
+    :param path_to_output: json file the results are written to
+    :type path_to_output: str
+
+    :param repeats: number of runs of every stage, the median is reported
+    :type repeats: int
+
+    :rtype: dict
+    :returns: the benchmark results
+    """
+    global REPEATS
+    REPEATS = repeats
+    report = {'meta': {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': sys.version.split()[0],
+                       'platform': platform.platform(),
+                       'cpu_count': os.cpu_count(),
+                       'num_topics': num_topics,
+                       'num_workers': num_workers,
+                       'repeats': repeats,
+                       'seed': seed},
+              'scales': {}}
+    for num_docs in scales:
+        scale_dir = tempfile.mkdtemp(prefix='bench' + str(num_docs) + '_', dir=workdir)
+        try:
+            print('benchmarking', num_docs, 'documents')
+            report['scales'][str(num_docs)] = benchmarkScale(num_docs, scale_dir, num_topics=num_topics, num_workers=num_workers, seed=seed)
+        finally:
+            shutil.rmtree(scale_dir)
+    os.makedirs(os.path.dirname(path_to_output) or '.', exist_ok=True)
+    with open(path_to_output, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def compareBenchmarks(path_to_baseline, path_to_current, threshold=1.2, min_seconds=0.01):
+    """
+    Prints the current/baseline time ratio (of the medians) of every stage at every shared scale,
+    flagging stages that got slower than threshold by more than min_seconds
+    (ratios of millisecond stages are mostly timer noise)
+
+    :rtype: list
+    :returns: list of (scale, stage, ratio) regressions
+    """
+    baseline = json.load(open(path_to_baseline))['scales']
+    current = json.load(open(path_to_current))['scales']
+    regressions = []
+    for scale in sorted(set(baseline) & set(current), key=int):
+        for stage in baseline[scale]:
+            if stage.startswith('num_') or stage == 'samples' or stage not in current[scale] or baseline[scale][stage] <= 0:
+                continue
+            ratio = current[scale][stage] / baseline[scale][stage]
+            regression = ratio > threshold and current[scale][stage] - baseline[scale][stage] > min_seconds
+            flag = ' <- regression' if regression else ''
+            print(scale, stage, round(baseline[scale][stage], 4), '->', round(current[scale][stage], 4), 'x' + str(round(ratio, 2)) + flag)
+            if regression:
+                regressions.append((scale, stage, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline on synthetic args.me-shaped corpora')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 5000, 20000], help='corpus sizes (number of arguments)')
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1, help='encoder processes used to build the index')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=5, help='runs of every stage, the median is reported')
+    parser.add_argument('--output', default='out/benchmarks/benchmark.' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+    parser.add_argument('--compare', default=None, help='baseline benchmark json to compare the new results against')
+    args = parser.parse_args()
+
+    runBenchmarks(args.scales, args.output, num_topics=args.topics, num_workers=args.workers, seed=args.seed, repeats=args.repeats)
+    print('results written to', args.output)
+    if args.compare:
+        compareBenchmarks(args.compare, args.output)
@@ -0,0 +1,177 @@
+import pickle
+import numpy as np
+
+class DocumentBlocks:
+    """
+    Passage vectors stored contiguously per document, with an offsets array:
+    the passages of block b are rows offsets[b]:offsets[b+1].
+    Any candidate list of documents can then be scored exactly against
+    query or feedback vectors with one matrix multiply and a segmented max/mean.
+    """
+
+    def __init__(self, vectors, offsets, docids):
+        """
+        :param vectors: normalized passage vectors, grouped by document (may be a memmap)
+        :type vectors: np.array
+
+        :param offsets: int64 array of len(docids) + 1 row offsets
+        :type offsets: np.array
+
+        :param docids: the docid of every block
+        :type docids: list of str
+        """
+        self.vectors = vectors
+        self.offsets = offsets
+        self.docids = docids
+        self.docid_to_block = {docid: i for i, docid in enumerate(docids)}
+
+    def __contains__(self, docid):
+        return docid in self.docid_to_block
+
+    def __len__(self):
+        return len(self.docids)
+
+    def passageVectors(self, docid):
+        """
+        :rtype: np.array
+        :returns: the passage vectors of a single document
+        """
+        block = self.docid_to_block[docid]
+        return np.asarray(self.vectors[self.offsets[block]:self.offsets[block+1]], dtype=np.float32)
+
+    def feedbackVectors(self, docids):
+        """
+        :rtype: np.array
+        :returns: the passage vectors of all the given documents, stacked (unknown docids are skipped)
+        """
+        blocks = [self.passageVectors(docid) for docid in docids if docid in self.docid_to_block]
+        if not blocks:
+            return np.empty((0, self.vectors.shape[1]), dtype=np.float32)
+        return np.concatenate(blocks)
+
+    def gather(self, docids):
+        """
+        Stacks the passage vectors of the candidate documents into one matrix
+
+        :param docids: the candidate documents
+        :type docids: list of str
+
+        :rtype: tuple
+        :returns: (found docids, passage matrix, start row of each document in the matrix, passages per document),
+                  candidates without passage vectors are skipped
+        """
+        found = [docid for docid in docids if docid in self.docid_to_block]
+        if not found:
+            return found, np.empty((0, self.vectors.shape[1]), dtype=np.float32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        blocks = np.array([self.docid_to_block[docid] for docid in found])
+        starts = self.offsets[blocks]
+        lengths = self.offsets[blocks + 1] - starts
+        segments = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        rows = np.repeat(starts - segments, lengths) + np.arange(lengths.sum())
+        return found, np.asarray(self.vectors[rows], dtype=np.float32), segments, lengths
+
+    def score(self, query_vectors, docids, agg='max'):
+        """
+        Exact cosine scores of the candidate documents.
+        Each passage is scored by its mean similarity over the query vectors,
+        and each document by the max (or mean) over its passages.
+
+        :param query_vectors: query or feedback vectors, one per row (need not be normalized)
+        :type query_vectors: np.array
+
+        :param docids: the candidate documents
+        :type docids: list of str
+
+        :param agg: 'max' or 'mean' over the passages of a document
+        :type agg: str
+
+        :rtype: list
+        :returns: (docid, score) for every candidate that has passage vectors, in candidate order
+        """
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        norms = np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        query_vectors = query_vectors / norms
+
+        found, passages, segments, lengths = self.gather(docids)
+        if not found:
+            return []
+        passage_scores = (passages @ query_vectors.T).mean(axis=1)
+        if agg == 'max':
+            doc_scores = np.maximum.reduceat(passage_scores, segments)
+        elif agg == 'mean':
+            doc_scores = np.add.reduceat(passage_scores, segments) / lengths
+        else:
+            raise ValueError('unknown aggregation: ' + str(agg))
+        return list(zip(found, doc_scores.tolist()))
+
+    def save(self, path_prefix):
+        """
+        Saves the offsets and docids (the vectors are saved by buildDocumentBlocks)
+        """
+        np.save(path_prefix + '.offsets.npy', self.offsets)
+        pickle.dump(self.docids, open(path_prefix + '.docids.p', 'wb'))
+
+
+def buildDocumentBlocks(path_to_vectors, idx_to_docid, path_prefix):
+    """
+    Groups the passage vectors by document and saves the block store.
+    Passages are written document by document by initializeSemantic, so usually every
+    document is already one contiguous run and the blocks point straight into the
+    existing vector file. Otherwise a regrouped copy is written to <path_prefix>.vectors.npy.
+
+    :param path_to_vectors: path to the normalized passage vectors (.npy), row i is passage i
+    :type path_to_vectors: str
+
+    :param idx_to_docid: the docid of every passage
+    :type idx_to_docid: list of str
+
+    :param path_prefix: prefix of the saved block store
+    :type path_prefix: str
+
+    :rtype: DocumentBlocks
+    :returns: the block store
+    """
+    vectors = np.load(path_to_vectors, mmap_mode='r')
+    # start of every run of equal docids
+    starts = [i for i in range(len(idx_to_docid)) if i == 0 or idx_to_docid[i] != idx_to_docid[i-1]]
+    docids = [idx_to_docid[i] for i in starts]
+
+    if len(set(docids)) == len(docids):
+        offsets = np.array(starts + [len(idx_to_docid)], dtype=np.int64)
+        path_to_blocks = path_to_vectors
+    else:
+        # some documents are split over several runs, regroup them with a stable sort
+        docids = list(dict.fromkeys(idx_to_docid))
+        block_of = {docid: i for i, docid in enumerate(docids)}
+        passage_blocks = np.array([block_of[docid] for docid in idx_to_docid])
+        order = np.argsort(passage_blocks, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(passage_blocks, minlength=len(docids)))]).astype(np.int64)
+        path_to_blocks = path_prefix + '.vectors.npy'
+        regrouped = np.lib.format.open_memmap(path_to_blocks, mode='w+', dtype=np.float32, shape=vectors.shape)
+        for start in range(0, len(order), 65536):
+            regrouped[start:start+65536] = vectors[order[start:start+65536]]
+        regrouped.flush()
+
+    with open(path_prefix + '.path', 'w') as f:
+        f.write(path_to_blocks)
+    blocks = DocumentBlocks(np.load(path_to_blocks, mmap_mode='r'), offsets, docids)
+    blocks.save(path_prefix)
+    return blocks
+
+
+def loadDocumentBlocks(path_prefix):
+    """
+    Loads a block store saved by buildDocumentBlocks, the vectors are memory mapped
+
+    :param path_prefix: prefix the block store was saved under
+    :type path_prefix: str
+
+    :rtype: DocumentBlocks
+    :returns: the block store
+    """
+    with open(path_prefix + '.path', 'r') as f:
+        path_to_blocks = f.read().strip()
+    offsets = np.load(path_prefix + '.offsets.npy')
+    docids = pickle.load(open(path_prefix + '.docids.p', 'rb'))
+    return DocumentBlocks(np.load(path_to_blocks, mmap_mode='r'), offsets, docids)
@@ -0,0 +1,152 @@
+import os
+import bisect
+import pickle
+import collections
+import collections.abc
+import numpy as np
+
+def writePassageStore(passages, path):
+    """
+    Writes the passages to disk as one utf-8 text blob (path.bin) and the byte offset of every passage (path.offsets.npy)
+
+    :param passages: the text of every passage
+    :type passages: list of str
+
+    :param path: path of the store, without extension
+    :type path: str
+
+    :rtype: None
+    :returns: Nothing
+    """
+    offsets = np.zeros(len(passages) + 1, dtype=np.int64)
+    with open(path + '.bin', 'wb') as f:
+        for i, passage in enumerate(passages):
+            data = passage.encode('utf-8')
+            f.write(data)
+            offsets[i+1] = offsets[i] + len(data)
+    np.save(path + '.offsets.npy', offsets)
+
+
+def loadPassageStore(path):
+    """
+    Opens a passage store. Stores that were not written yet are converted from the pickled passage list (path.p)
+
+    :param path: path of the store, without extension (e.g. out/semantic/idx_to_passage)
+    :type path: str
+
+    :rtype: PassageStore
+    :returns: the store
+    """
+    if not os.path.exists(path + '.offsets.npy'):
+        writePassageStore(pickle.load(open(path + '.p', 'rb')), path)
+    return PassageStore(path)
+
+
+class PassageStore(collections.abc.Sequence):
+    """
+    The passage texts, memory mapped from a store written by writePassageStore.
+    Indexing decodes a single passage, nothing else is held in memory.
+    """
+
+    def __init__(self, path):
+        self.offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+        # np.memmap cannot map an empty file
+        self.data = np.memmap(path + '.bin', dtype=np.uint8, mode='r') if self.offsets[-1] else np.empty(0, dtype=np.uint8)
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class ChainedPassageStore(collections.abc.Sequence):
+    """
+    Several passage stores indexed as one sequence (e.g. the stores of all shards, in order)
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.starts = np.cumsum([0] + [len(store) for store in stores])
+
+    def __getitem__(self, i):
+        store = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return self.stores[store][i - self.starts[store]]
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+
+class LazyDocMap(collections.abc.Mapping):
+    """
+    Drop-in replacement for the docid_to_doc dict: docid -> list of passages.
+    Instead of materializing the lists for the whole corpus, a compact sorted index over
+    idx_to_docid is searched with binary search on first access, and the resolved documents
+    are kept in a bounded LRU cache. With idx_to_passage a PassageStore the passages are read from disk,
+    so only recently touched documents occupy memory.
+    """
+
+    def __init__(self, idx_to_docid, idx_to_passage, cache_size=4096):
+        """
+        :param idx_to_docid: the docid of every passage
+        :type idx_to_docid: list of str
+
+        :param idx_to_passage: the text of every passage (any indexable sequence, a PassageStore to keep it on disk)
+        :type idx_to_passage: PassageStore or list of str
+
+        :param cache_size: maximum number of documents kept resolved
+        :type cache_size: int
+        """
+        self.idx_to_passage = idx_to_passage
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # stable sort, so the passages of a document keep their original order
+        order = sorted(range(len(idx_to_docid)), key=idx_to_docid.__getitem__)
+        self.order = np.array(order, dtype=np.int64)
+        # unique sorted docids, and where each one's passages start in order
+        self.sorted_docids = []
+        starts = []
+        for position, passage_idx in enumerate(order):
+            docid = idx_to_docid[passage_idx]
+            if not self.sorted_docids or self.sorted_docids[-1] != docid:
+                self.sorted_docids.append(docid)
+                starts.append(position)
+        starts.append(len(order))
+        self.starts = np.array(starts, dtype=np.int64)
+
+    def find(self, docid):
+        """
+        :rtype: int
+        :returns: position of docid in the sorted keys, or -1 if it is not in the corpus
+        """
+        i = bisect.bisect_left(self.sorted_docids, docid)
+        if i < len(self.sorted_docids) and self.sorted_docids[i] == docid:
+            return i
+        return -1
+
+    def __getitem__(self, docid):
+        if docid in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(docid)
+            return self.cache[docid]
+        i = self.find(docid)
+        if i < 0:
+            raise KeyError(docid)
+        self.misses += 1
+        passages = [self.idx_to_passage[passage_idx] for passage_idx in self.order[self.starts[i]:self.starts[i+1]]]
+        self.cache[docid] = passages
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return passages
+
+    def __contains__(self, docid):
+        return docid in self.cache or self.find(docid) >= 0
+
+    def __iter__(self):
+        return iter(self.sorted_docids)
+
+    def __len__(self):
+        return len(self.sorted_docids)
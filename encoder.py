@@ -0,0 +1,150 @@
+import os
+import time
+import multiprocessing
+import numpy as np
+import profiler
+
+# The model used by each pool worker, set once per process by initWorker
+worker_model = None
+
+def initWorker(model, threads_per_worker):
+    """
+    Pool initializer, gives each worker process its own copy of the model
+    and limits the number of threads torch uses inside that worker
+
+    :param model: SentenceTransformer model used to encode passages
+    :type model: SentenceTransformer
+
+    :param threads_per_worker: number of intra-op threads each worker may use
+    :type threads_per_worker: int
+
+    :rtype: None
+    :returns: Nothing
+    """
+    global worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads_per_worker)
+    except ImportError:
+        # models that do not run on torch (e.g. the benchmark stand-in encoder)
+        pass
+    worker_model = model
+
+
+def encodeBucket(bucket):
+    """
+    Encodes a single bucket of passages inside a pool worker
+
+    :param bucket: (positions, passages, batch_size) where positions are the passage ids of the bucket
+    :type bucket: tuple
+
+    :rtype: tuple
+    :returns: (positions, encoded passages)
+    """
+    positions, passages, batch_size = bucket
+    return positions, worker_model.encode(passages, batch_size=batch_size)
+
+
+def createBuckets(passages, bucket_size=256):
+    """
+    Sorts the passages by length and groups them into buckets,
+    so every batch the encoder sees has passages of similar length (less padding)
+
+    :param passages: list of passage strings
+    :type passages: list of strings
+
+    :param bucket_size: number of passages per bucket
+    :type bucket_size: int
+
+    :rtype: list of arrays
+    :returns: list of passage id arrays, one per bucket
+    """
+    lengths = np.array([len(passage.split()) for passage in passages])
+    order = np.argsort(lengths, kind='stable')
+    return [order[i:i+bucket_size] for i in range(0, len(order), bucket_size)]
+
+
+def iterEncodedBuckets(passages, model, num_workers=None, threads_per_worker=None, bucket_size=256, batch_size=32):
+    """
+    Encodes all passages by sharding length-sorted buckets across a pool of worker processes.
+    Each worker holds its own copy of the model (inherited through fork).
+    The buckets are yielded as they come back (in no particular order), so the caller can
+    consume the vectors without holding all of them in memory.
+
+    :param passages: list of passage strings, the position of a passage is its id
+    :type passages: list of strings
+
+    :param model: SentenceTransformer model used to encode passages
+    :type model: SentenceTransformer
+
+    :param num_workers: number of worker processes (default=number of cores)
+    :type num_workers: int
+
+    :param threads_per_worker: torch threads per worker (default=cores / num_workers)
+    :type threads_per_worker: int
+
+    :param bucket_size: number of passages sent to a worker at a time
+    :type bucket_size: int
+
+    :param batch_size: batch size used by the model inside a bucket
+    :type batch_size: int
+
+    :rtype: generator
+    :returns: (passage ids, float32 vectors) of every bucket
+    """
+    cores = os.cpu_count() or 1
+    if num_workers is None:
+        num_workers = cores
+    if threads_per_worker is None:
+        threads_per_worker = max(1, cores // num_workers)
+
+    buckets = [(ids, [passages[i] for i in ids], batch_size) for ids in createBuckets(passages, bucket_size)]
+
+    start = time.time()
+    done = 0
+    last_report = start
+
+    def report(final=False):
+        elapsed = time.time() - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        print(done, 'of', len(passages), 'passages encoded,', round(rate, 1), 'passages/s' + (' (done)' if final else ''))
+
+    if num_workers <= 1:
+        # No pool needed, but still benefit from the length sorted buckets
+        encoded_buckets = ((positions, model.encode(bucket_passages, batch_size=batch_size)) for positions, bucket_passages, _ in buckets)
+    else:
+        # fork so that the already loaded model is inherited instead of pickled
+        context = multiprocessing.get_context('fork')
+        pool = context.Pool(num_workers, initializer=initWorker, initargs=(model, threads_per_worker))
+        encoded_buckets = pool.imap_unordered(encodeBucket, buckets)
+    try:
+        for positions, vectors in encoded_buckets:
+            yield positions, np.asarray(vectors, dtype=np.float32)
+            done += len(positions)
+            if time.time() - last_report > 30:
+                report()
+                last_report = time.time()
+    finally:
+        if num_workers > 1:
+            pool.terminate()
+    report(final=True)
+    profiler.count('passages_encoded', len(passages))
+
+
+@profiler.timed('encodePassages')
+def encodePassages(passages, model, num_workers=None, threads_per_worker=None, bucket_size=256, batch_size=32, embedding_size=768):
+    """
+    Encodes all passages into one matrix, see iterEncodedBuckets.
+    For large corpora prefer consuming iterEncodedBuckets directly, this holds every vector in memory.
+
+    :param embedding_size: dimension of the passage vectors
+    :type embedding_size: int
+
+    :rtype: np.array
+    :returns: float32 array of shape (len(passages), embedding_size), row i is passage i
+    """
+    encoded = np.empty((len(passages), embedding_size), dtype=np.float32)
+    for positions, vectors in iterEncodedBuckets(passages, model, num_workers=num_workers, threads_per_worker=threads_per_worker,
+                                                 bucket_size=bucket_size, batch_size=batch_size):
+        encoded[positions] = vectors
+    return encoded
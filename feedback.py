@@ -0,0 +1,117 @@
+import numpy as np
+import searcher
+import reranker
+import profiler
+
+@profiler.timed('bm25Rm3Search')
+def bm25Rm3Search(pyserini_searcher, topics, fb_terms=10, fb_docs=10, original_query_weight=0.5, k1=3.2, b=0.15, threads=8):
+    """
+    BM25 search with RM3 query expansion (needs the index built with -storeDocvectors).
+    All topics are expanded and searched in one multi-threaded batch_search call.
+
+    :param pyserini_searcher: the pyserini SimpleSearcher instantiated on the corpora
+    :type pyserini_searcher: pyserini SimpleSearcher
+
+    :param topics: dict of the topic file
+    :type topics: dict
+
+    :param fb_terms: number of expansion terms
+    :type fb_terms: int
+
+    :param fb_docs: number of feedback documents
+    :type fb_docs: int
+
+    :param original_query_weight: weight of the original query terms in the expanded query
+    :type original_query_weight: float
+
+    :param threads: number of search threads
+    :type threads: int
+
+    :rtype: dict
+    :returns: dictionary where the keys are the topics and the values are sorted (docid, score) run lists
+    """
+    pyserini_searcher.set_rm3(fb_terms=fb_terms, fb_docs=fb_docs, original_query_weight=original_query_weight)
+    try:
+        run = searcher.bm25Search(pyserini_searcher, topics, k1=k1, b=b, threads=threads)
+    finally:
+        # leave the shared searcher as plain bm25
+        pyserini_searcher.unset_rm3()
+    return run
+
+
+def rocchioQueries(encoded_queries, feedback, alpha=1.0, beta=0.75):
+    """
+    Rocchio-style dense query update: alpha * query + beta * mean of the feedback passage vectors
+
+    :param encoded_queries: one query vector per topic
+    :type encoded_queries: np.array
+
+    :param feedback: the feedback passage vectors of each topic (possibly empty)
+    :type feedback: list of np.array
+
+    :param alpha: weight of the original query
+    :type alpha: float
+
+    :param beta: weight of the feedback centroid
+    :type beta: float
+
+    :rtype: np.array
+    :returns: the expanded, normalized query vectors
+    """
+    encoded_queries = np.asarray(encoded_queries, dtype=np.float32)
+    expanded = alpha * encoded_queries / np.linalg.norm(encoded_queries, axis=1, keepdims=True)
+    for i, vectors in enumerate(feedback):
+        if len(vectors) > 0:
+            expanded[i] += beta * vectors.mean(axis=0)
+    norms = np.linalg.norm(expanded, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return expanded / norms
+
+
+@profiler.timed('rocchioSearch')
+def rocchioSearch(path_to_run, model, topics, index, idx_to_docid, doc_blocks, fb_docs=3, alpha=1.0, beta=0.75, k=1000):
+    """
+    Dense pseudo relevance feedback: the passage vectors of the top fb_docs documents of a run
+    are looked up in the document block store (not re-encoded) and averaged into the query embedding,
+    then all expanded queries are searched with a single knn_query call
+
+    :param path_to_run: path to the run the feedback documents are taken from
+    :type path_to_run: str
+
+    :param model: the semantic encoder
+    :type model: SentenceTransformer
+
+    :param topics: dict of the topics
+    :type topics: dict
+
+    :param index: the hnswlib index for knn search
+    :type index: hnswlib.Index
+
+    :param idx_to_docid: the mapping between the hnswlib index output and the docid
+    :type idx_to_docid: array
+
+    :param doc_blocks: the document block store
+    :type doc_blocks: docblocks.DocumentBlocks
+
+    :param fb_docs: number of feedback documents per topic
+    :type fb_docs: int
+
+    :param alpha: weight of the original query
+    :type alpha: float
+
+    :param beta: weight of the feedback centroid
+    :type beta: float
+
+    :param k: number of neighbors to retrieve
+    :type k: int
+
+    :rtype: dict
+    :returns: dictionary where the keys are the topics and the values are sorted (docid, score) run lists
+    """
+    run = reranker.loadRun(path_to_run)
+    topic_nums = [topic for topic in topics]
+    encoded_queries = model.encode([topics[topic]['title'] for topic in topic_nums])
+    profiler.count('queries_encoded', len(topic_nums))
+    feedback = [doc_blocks.feedbackVectors([docid for docid,_ in run.get(topic, [])[:fb_docs]]) for topic in topic_nums]
+    expanded_queries = rocchioQueries(encoded_queries, feedback, alpha=alpha, beta=beta)
+    return searcher.vectorSearch(topic_nums, expanded_queries, index, idx_to_docid, k=k)
@@ -1,13 +1,80 @@
 import processor
+import encoder
+import quantizer
+import shards
+import docblocks
+import docstore
+import profiler
 import os
 import json
 import pickle
 import hnswlib
+import numpy as np
+import multiprocessing
+import time
+
+def convertCorpus(job):
+    """
+    Pool worker for initializePyserini, streams the documents of one corpus file
+    into pyserini-formatted JSONL shards of at most docs_per_shard documents.
+    The corpus file is decoded one document at a time, so a worker never holds the parsed file
+
+    :param job: (path to the corpus file, output directory, corpus name, docs_per_shard)
+    :type job: tuple
+
+    :rtype: tuple
+    :returns: (corpus name, number of documents converted)
+    """
+    path_to_corpus_file, path_to_corpus_output, corpus_name, docs_per_shard = job
+    num_docs = 0
+    f = None
+    try:
+        for doc in processor.iterArguments(path_to_corpus_file):
+            if num_docs % docs_per_shard == 0:
+                if f: f.close()
+                f = open(os.path.join(path_to_corpus_output, corpus_name + '.' + str(num_docs // docs_per_shard) + '.jsonl'), 'w')
+            text = [x['text'] for x in doc['premises']]
+            # each document is written as soon as it is converted, no rewritten list is held
+            f.write(json.dumps({'id': doc['id'], 'contents': " ".join(text)}) + '\n')
+            num_docs += 1
+    finally:
+        if f: f.close()
+    return corpus_name, num_docs
+
+
+def indexSize(path_to_idx_output):
+    """
+    Total size in bytes of the files in the index directory, used to report indexing progress
+    """
+    size = 0
+    for name in os.listdir(path_to_idx_output):
+        try:
+            size += os.path.getsize(os.path.join(path_to_idx_output, name))
+        except OSError:
+            # lucene removes merged segment files while we look
+            pass
+    return size
+
+
+def runIndexer(args):
+    """
+    Process target for initializePyserini, runs the Anserini indexer (and with it the JVM) in its own process
+
+    :param args: IndexCollection command line arguments
+    :type args: list of str
+    """
+    from pyserini.pyclass import autoclass
+    autoclass('io.anserini.index.IndexCollection').main(args)
+
 
 # initialize the pyserini search
-def initializePyserini(path_to_corpus_dir, path_to_corpus_output, path_to_idx_output):
+@profiler.timed('initializePyserini')
+def initializePyserini(path_to_corpus_dir, path_to_corpus_output, path_to_idx_output, num_workers=None, threads=None, docs_per_shard=50000):
     """
-    Formats the json files to match pyserini input, then builds the index
+    Formats the json files to match pyserini input, then builds the index.
+    The corpus files are converted in parallel into JSONL shards, and the Lucene
+    indexer is run with one indexing thread per core in a spawned child process, so the JVM never
+    runs in this process and the fork pools of initializeSemantic(Shards) stay safe afterwards.
 
     :param path_to_corpus_dir: path to where all the json files are
     :type path_to_corpus dir: str
@@ -18,28 +85,82 @@ def initializePyserini(path_to_corpus_dir, path_to_corpus_output, path_to_idx_ou
     :param path_to_idx_output: path where the pyserini index is saved
     :type path_to_idx_output: str
 
+    :param num_workers: number of corpus files converted at the same time (default=number of cores)
+    :type num_workers: int
+
+    :param threads: number of Lucene indexing threads (default=number of cores)
+    :type threads: int
+
+    :param docs_per_shard: maximum number of documents per JSONL shard, more shards let more indexing threads work
+    :type docs_per_shard: int
+
     :rtype: None
     :returns: Nothing
     """
-    # Format and rewrite each corpus
-    for corpus_name in os.listdir(path_to_corpus_dir):
-        corpus = json.load(open(path_to_corpus_dir + corpus_name, 'r'))
-        documents = []
-        for doc in corpus['arguments']:
-            text = [x['text'] for x in doc['premises']]
-            documents.append({'id': doc['id'], 'contents': " ".join(text)})
-        with open(path_to_corpus_output + corpus_name, 'w') as f:
-            json.dump(documents, f)
-
-    # Run pyserini command to build index
-    # I know I know, this is probably the worst way to do it, I should just call the pyserini index directly
-    cs_default = "python3 -m pyserini.index -collection JsonCollection -generator DefaultLuceneDocumentGenerator -threads 1"
-    cs_input = " -input " + path_to_corpus_output
-    cs_output = " -index " + path_to_idx_output + " -storePositions -storeDocvectors -storeRaw"
-    os.system(cs_default + cs_input + cs_output)
-    
+    cores = os.cpu_count() or 1
+    corpus_names = os.listdir(path_to_corpus_dir)
+    num_workers = min(num_workers or cores, max(1, len(corpus_names)))
+    threads = threads or cores
+
+    # Format and rewrite each corpus, one worker process per corpus file
+    # (spawned like the indexer, so no process is ever forked from one with a JVM)
+    jobs = [(path_to_corpus_dir + corpus_name, path_to_corpus_output, os.path.splitext(corpus_name)[0], docs_per_shard) for corpus_name in corpus_names]
+    start = time.time()
+    total_docs = 0
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        for corpus_name, num_docs in pool.imap_unordered(convertCorpus, jobs):
+            total_docs += num_docs
+            print('converted', corpus_name, '-', total_docs, 'documents,', round(total_docs / max(time.time() - start, 1e-9), 1), 'docs/s')
+    profiler.count('docs_converted', total_docs)
+
+    # Build the index with the Anserini indexer in a spawned child process,
+    # this process only looks at the index directory to report the progress
+    args = ['-collection', 'JsonCollection', '-generator', 'DefaultLuceneDocumentGenerator', '-threads', str(threads),
+            '-input', path_to_corpus_output, '-index', path_to_idx_output, '-storePositions', '-storeDocvectors', '-storeRaw']
+    start = time.time()
+    indexer = multiprocessing.get_context('spawn').Process(target=runIndexer, args=(args,))
+    indexer.start()
+    try:
+        while indexer.is_alive():
+            indexer.join(30)
+            if indexer.is_alive() and os.path.isdir(path_to_idx_output):
+                print('indexing with', threads, 'threads:', round(time.time() - start), 's,', round(indexSize(path_to_idx_output) / 2 ** 20, 1), 'MB written')
+    finally:
+        if indexer.is_alive():
+            indexer.terminate()
+    if indexer.exitcode != 0:
+        raise RuntimeError('the indexer exited with code ' + str(indexer.exitcode))
+    print('indexed', total_docs, 'documents in', round(time.time() - start, 1), 's')
+
+
+@profiler.timed('loadPassages')
+def loadPassages(path_to_corpus_file):
+    """
+    Splits every document of a corpus file into passages
+
+    :param path_to_corpus_file: path to a single json corpus file
+    :type path_to_corpus_file: str
+
+    :rtype: tuple
+    :returns: (passages, docids) lists, where docids[i] is the document passages[i] came from
+    """
+    passages = []
+    docids = []
+    num_docs = 0
+    for doc in processor.iterArguments(path_to_corpus_file):
+        text = " ".join([x['text'] for x in doc['premises']])
+        sentences = processor.createSentences(text)
+        doc_passages = processor.createPassages(sentences)
+        passages += doc_passages
+        docids += [doc['id']] * len(doc_passages)
+        num_docs += 1
+    profiler.count('docs_processed', num_docs)
+    profiler.count('passages_created', len(passages))
+    return passages, docids
 
-def initializeSemantic(path_to_corpus_dir, path_to_semantic_output, model):
+
+@profiler.timed('initializeSemantic')
+def initializeSemantic(path_to_corpus_dir, path_to_semantic_output, model, num_workers=None, max_elements=700000):
     """
     Encodes all corpus text and saves it in a hnswlib index.
     Note that this encoding happens on a passage level, which is just
@@ -56,6 +177,12 @@ def initializeSemantic(path_to_corpus_dir, path_to_semantic_output, model):
     :param model: SentenceTransformer model used to encode passages
     :type model: SentenceTransformer
 
+    :param num_workers: number of processes used to encode the passages (default=number of cores)
+    :type num_workers: int
+
+    :param max_elements: capacity of the hnswlib index, should be at least the number of passages
+    :type max_elements: int
+
     :rtype: None
     :returns: Nothing
     """
@@ -68,32 +195,158 @@ def initializeSemantic(path_to_corpus_dir, path_to_semantic_output, model):
     # If a different corpus is used, the max_elements probably should be changed
     embedding_size = 768
     index = hnswlib.Index(space = 'cosine', dim = embedding_size)
-    index.init_index(max_elements = 700000, ef_construction = 300, M = 64)
+    index.init_index(max_elements = max_elements, ef_construction = 300, M = 64)
 
     # Loop through each corpus, processing the text
     for corpus_name in os.listdir(path_to_corpus_dir):
-        corpus = json.load(open(path_to_corpus_dir + corpus_name, 'r'))
         print('processing corpus', corpus_name)
-        for doc in corpus['arguments']:
-            docid = doc['id']
-            text = " ".join([x['text'] for x in doc['premises']])
-            sentences = processor.createSentences(text)
-            passages = processor.createPassages(sentences)
-            # Save both the processed passages, and which document they came from
-            idx_to_passage += passages
-            idx_to_passageid += [docid] * len(passages)
-            #for i in range(len(passages)):
-            #    idx_to_passageid.append(docid + '.' + str(i))
+        passages, docids = loadPassages(path_to_corpus_dir + corpus_name)
+        # Save both the processed passages, and which document they came from
+        idx_to_passage += passages
+        idx_to_passageid += docids
 
     # Now that all the passages are made, we can encode them and add them to the index
-    # Encode in batches of 1000 to make things a bit faster
-    for i in range(0, len(idx_to_passage), 1000):
-        encoded_passages = model.encode(idx_to_passage[i:i+1000])
-        index.add_items(encoded_passages)
-        if i % 10000 == 0: print(i, 'documents encoded')
+    # Encoding is sharded across worker processes, each bucket is added as soon as it comes back
+    # The exact (normalized) vectors are kept as well, they back the compressed index tiers.
+    # They are written straight into the .npy file, so no full matrix is held in memory
+    passage_vectors = np.lib.format.open_memmap(path_to_semantic_output + 'passage_vectors.npy', mode='w+',
+                                                dtype=np.float32, shape=(len(idx_to_passage), embedding_size))
+    for positions, vectors in encoder.iterEncodedBuckets(idx_to_passage, model, num_workers=num_workers):
+        index.add_items(vectors, positions)
+        passage_vectors[positions] = quantizer.normalize(vectors)
+    passage_vectors.flush()
+    del passage_vectors
 
     # Finally, the index and lookup arrays are saved to the provided path
     index.save_index(path_to_semantic_output + 'passage.index')
     pickle.dump(idx_to_passageid, open(path_to_semantic_output + 'idx_to_passageid.p', 'wb'))
     pickle.dump(idx_to_passage, open(path_to_semantic_output + 'idx_to_passage.p', 'wb'))
+    # the passage texts are also stored for memory mapped lookups (docstore.loadPassageStore)
+    docstore.writePassageStore(idx_to_passage, path_to_semantic_output + 'idx_to_passage')
+
+
+def savePassageVectors(path_to_semantic_output):
+    """
+    Makes sure the normalized passage vectors are saved next to the index.
+    If they were not saved by initializeSemantic, they are read back out of the hnswlib index.
+
+    :param path_to_semantic_output: directory where the semantic index data is saved
+    :type path_to_semantic_output: str
+
+    :rtype: str
+    :returns: path to the saved vectors
+    """
+    path_to_vectors = path_to_semantic_output + 'passage_vectors.npy'
+    if not os.path.exists(path_to_vectors):
+        index = hnswlib.Index(space = 'cosine', dim = 768)
+        index.load_index(path_to_semantic_output + 'passage.index')
+        np.save(path_to_vectors, quantizer.vectorsFromIndex(index))
+    return path_to_vectors
+
+
+@profiler.timed('initializeDocumentBlocks')
+def initializeDocumentBlocks(path_to_semantic_output):
+    """
+    Builds the document block store (passage vectors contiguous per document) used for exact document scoring
+
+    :param path_to_semantic_output: directory where the semantic index data is saved
+    :type path_to_semantic_output: str
+
+    :rtype: None
+    :returns: Nothing
+    """
+    idx_to_docid = pickle.load(open(path_to_semantic_output + 'idx_to_passageid.p', 'rb'))
+    docblocks.buildDocumentBlocks(savePassageVectors(path_to_semantic_output), idx_to_docid, path_to_semantic_output + 'doc_blocks')
+
+
+@profiler.timed('initializeCompressed')
+def initializeCompressed(path_to_semantic_output, tier='int8', ivf_lists=1024):
+    """
+    Builds a compressed tier (float16, int8 or pq) over the saved passage vectors
+
+    :param path_to_semantic_output: directory where the semantic index data is saved
+    :type path_to_semantic_output: str
+
+    :param tier: 'float16', 'int8' or 'pq'
+    :type tier: str
+
+    :param ivf_lists: number of inverted lists, so a query only scans the codes of the closest lists (None scans all)
+    :type ivf_lists: int
+
+    :rtype: None
+    :returns: Nothing
+    """
+    vectors = np.load(savePassageVectors(path_to_semantic_output), mmap_mode='r')
+    compressed_index = quantizer.buildCompressedIndex(vectors, tier=tier, ivf_lists=ivf_lists)
+    compressed_index.save(path_to_semantic_output + 'passage.' + tier)
             
+
+
+def buildShard(shard):
+    """
+    Pool worker for initializeSemanticShards, builds the hnswlib shard of a single corpus file.
+    Uses the model set up by encoder.initWorker.
+
+    :param shard: (path to the corpus file, shard output directory, shard name)
+    :type shard: tuple
+
+    :rtype: tuple
+    :returns: (shard name, number of passages, profiler record of the worker)
+    """
+    path_to_corpus_file, path_to_shard_output, name = shard
+    # the worker's stages and counters are returned, the parent merges them into its profiler
+    with profiler.collect() as worker_profile:
+        passages, docids = loadPassages(path_to_corpus_file)
+        index = hnswlib.Index(space = 'cosine', dim = 768)
+        index.init_index(max_elements = max(1, len(passages)), ef_construction = 300, M = 64)
+        # length sorted buckets keep the padding low, the labels are the passage positions
+        for positions in encoder.createBuckets(passages):
+            index.add_items(encoder.worker_model.encode([passages[i] for i in positions]), positions, num_threads=1)
+        index.save_index(os.path.join(path_to_shard_output, name + '.index'))
+        pickle.dump(docids, open(os.path.join(path_to_shard_output, name + '.docids.p'), 'wb'))
+        pickle.dump(passages, open(os.path.join(path_to_shard_output, name + '.passages.p'), 'wb'))
+        docstore.writePassageStore(passages, os.path.join(path_to_shard_output, name + '.passages'))
+    return name, len(passages), worker_profile
+
+
+@profiler.timed('initializeSemanticShards')
+def initializeSemanticShards(path_to_corpus_dir, path_to_shard_output, model, corpus_names=None, num_workers=None):
+    """
+    Builds one hnswlib shard per corpus file, in parallel, and registers them in the shard manifest.
+    Passing corpus_names only (re)builds those shards, the rest are left untouched.
+
+    :param path_to_corpus_dir: path to where all the json files are
+    :type path_to_corpus_dir: str
+
+    :param path_to_shard_output: directory where the shards and the manifest are saved
+    :type path_to_shard_output: str
+
+    :param model: SentenceTransformer model used to encode passages
+    :type model: SentenceTransformer
+
+    :param corpus_names: corpus files to (re)build, default is every file in path_to_corpus_dir
+    :type corpus_names: list of str
+
+    :param num_workers: number of shards built at the same time (default=number of cores)
+    :type num_workers: int
+
+    :rtype: shards.ShardedIndex
+    :returns: the sharded index, including the new shards
+    """
+    if corpus_names is None:
+        corpus_names = os.listdir(path_to_corpus_dir)
+    cores = os.cpu_count() or 1
+    num_workers = min(num_workers or cores, max(1, len(corpus_names)))
+    jobs = [(path_to_corpus_dir + corpus_name, path_to_shard_output, os.path.splitext(corpus_name)[0]) for corpus_name in corpus_names]
+
+    sharded_index = shards.ShardedIndex(path_to_shard_output)
+    # fork so that the already loaded model is inherited instead of pickled
+    context = multiprocessing.get_context('fork')
+    with context.Pool(num_workers, initializer=encoder.initWorker, initargs=(model, max(1, cores // num_workers))) as pool:
+        for name, num_passages, worker_profile in pool.imap_unordered(buildShard, jobs):
+            # the loadPassages stage and counters of the worker
+            profiler.merge(worker_profile)
+            # only the parent process writes the manifest
+            sharded_index.registerShard(name)
+            print('built shard', name, 'with', num_passages, 'passages')
+    return sharded_index
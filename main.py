@@ -2,13 +2,16 @@ import initializer
 import processor
 import searcher
 import reranker
+import quantizer
+import shards
+import profiler
+import docblocks
+import docstore
+import feedback
 
 import pickle
 import os
 import hnswlib
-from sentence_transformers import SentenceTransformer
-from sentence_transformers import CrossEncoder
-from pyserini.search import SimpleSearcher
 
 # corpus paths
 path_to_corpus_dir = 'debates/'
@@ -19,14 +22,11 @@ path_to_idx_output = 'out/pyserini/index/'
 
 # semantic paths
 path_to_semantic_output = 'out/semantic/'
+path_to_shard_output = 'out/semantic/shards/'
 
 # run path
 path_to_run_output = 'out/runs/'
 
-# embedding models
-semantic_model = SentenceTransformer('msmarco-distilbert-base-v3')
-cross_encoder_model = CrossEncoder('cross-encoder/ms-marco-TinyBERT-L-6', max_length=512)
-
 # topic path
 #path_to_topics = 'metadata/topics-task-1.xml' # note that these are the old titles
 path_to_topics = 'metadata/topics-task-1-only-titles.xml'
@@ -44,86 +44,188 @@ setup = True
 evaluate = True
 # flag to view some results (setup must be true)
 view = True
-
-if initialize:
-    os.mkdir('out')
-    os.mkdir('out/pyserini')
-    os.mkdir(path_to_corpus_output)
-    os.mkdir(path_to_idx_output)
-
-    os.mkdir(path_to_semantic_output)
-    
-    initializer.initializePyserini(path_to_corpus_dir, path_to_corpus_output, path_to_idx_output)
-    initializer.initializeSemantic(path_to_corpus_dir, path_to_semantic_output, semantic_model)
-
-if setup:
-
-    # load the semantic knn index + passage lookup files
-    hnswlib_index = hnswlib.Index(space = 'cosine', dim=768)
-    hnswlib_index.load_index(path_to_semantic_output + 'passage.index')
-    hnswlib_index.set_ef(1100)
+# compressed vector tier to search instead of the hnswlib index: None, 'float16', 'int8' or 'pq'
+compressed_tier = None
+# flag to score the manifold cutoff run (5) exactly with the document block store
+exact_cutoff = False
+# flag to also produce the query expansion runs (bm25 + rm3, and rocchio dense feedback on run 3)
+expand = False
+# flag to use one semantic index shard per corpus file instead of a single index
+# (no compressed_tier, exact_cutoff or expand, they need the passage vectors of the single index)
+sharded = False
+# flag to write the runs in the binary run format (runfile.py), export with runfile.binaryToTrec for trec_eval
+binary_runs = False
+# flag to compare the recall of the compressed tier against the hnswlib index (setup must be true, and compressed_tier set)
+compare_recall = False
+
+# flag to time each stage and write a json report per run to path_to_profile_output
+profile = True
+# stages to additionally run under cProfile (or the sampling profiler), e.g. ['manifoldRerank'] or ['*']
+profile_stages = []
+profile_mode = 'cprofile'
+path_to_profile_output = 'out/profiles/'
+
+# the pipeline only runs when executed as a script: spawned worker processes (initializePyserini)
+# re-import this module, and must not load the models or start the JVM again
+if __name__ == '__main__':
+    # the shards keep no passage vectors, which the compressed tiers and the document blocks are built from
+    if sharded and (compressed_tier or exact_cutoff or expand):
+        raise ValueError('sharded cannot be combined with compressed_tier, exact_cutoff or expand')
+    # the recall is compared for the tier that is built and searched
+    if compare_recall and not compressed_tier:
+        raise ValueError('compare_recall needs a compressed_tier')
+
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers import CrossEncoder
+    from pyserini.search import SimpleSearcher
+
+    # embedding models
+    semantic_model = SentenceTransformer('msmarco-distilbert-base-v3')
+    cross_encoder_model = CrossEncoder('cross-encoder/ms-marco-TinyBERT-L-6', max_length=512)
+
+    if profile:
+        profiler.PROFILER.enable(profile_stages=profile_stages, profile_mode=profile_mode, profile_dir=path_to_profile_output + 'stages/')
+
+    if initialize:
+        os.mkdir('out')
+        os.mkdir('out/pyserini')
+        os.mkdir(path_to_corpus_output)
+        os.mkdir(path_to_idx_output)
+
+        os.mkdir(path_to_semantic_output)
     
-    idx_to_docid = pickle.load(open(path_to_semantic_output + 'idx_to_passageid.p', 'rb'))
-    idx_to_passage = pickle.load(open(path_to_semantic_output + 'idx_to_passage.p', 'rb'))
-
-    # construct reverse lookup for full document reranking
-    docid_to_doc = {}
-    for i,full_docid in enumerate(idx_to_docid):
-        if full_docid not in docid_to_doc:
-            docid_to_doc[full_docid] = []
-        docid_to_doc[full_docid].append(idx_to_passage[i])
+        initializer.initializePyserini(path_to_corpus_dir, path_to_corpus_output, path_to_idx_output)
+        if sharded:
+            os.mkdir(path_to_shard_output)
+            initializer.initializeSemanticShards(path_to_corpus_dir, path_to_shard_output, semantic_model)
+        else:
+            initializer.initializeSemantic(path_to_corpus_dir, path_to_semantic_output, semantic_model)
+            if compressed_tier:
+                initializer.initializeCompressed(path_to_semantic_output, tier=compressed_tier)
+            if exact_cutoff or expand:
+                initializer.initializeDocumentBlocks(path_to_semantic_output)
+
+    if setup:
+
+        if sharded:
+            # load the semantic shards, their global labels map to docids through sharded_index.docids
+            with profiler.stage('load_index'):
+                hnswlib_index = shards.ShardedIndex(path_to_shard_output, ef=1100)
+                idx_to_docid = hnswlib_index.docids
+
+            # construct lazy reverse lookup for full document reranking, the passages stay on disk
+            with profiler.stage('docid_to_doc'):
+                passage_docids, passages = hnswlib_index.passageLookups()
+                docid_to_doc = docstore.LazyDocMap(passage_docids, passages)
+
+        else:
+            # load the semantic knn index + passage lookup files
+            # the compressed tier has the same knn_query interface and replaces the hnswlib index,
+            # which is then only loaded when its recall is compared
+            with profiler.stage('load_index'):
+                if compressed_tier:
+                    hnswlib_index = quantizer.loadCompressedIndex(path_to_semantic_output + 'passage.' + compressed_tier, path_to_semantic_output + 'passage_vectors.npy', shortlist=1100)
+                else:
+                    hnswlib_index = hnswlib.Index(space = 'cosine', dim=768)
+                    hnswlib_index.load_index(path_to_semantic_output + 'passage.index')
+                    hnswlib_index.set_ef(1100)
+
+            if compare_recall:
+                compressed_index = hnswlib_index
+                full_index = hnswlib.Index(space = 'cosine', dim=768)
+                full_index.load_index(path_to_semantic_output + 'passage.index')
+                full_index.set_ef(1100)
+                topic_vectors = semantic_model.encode([topic['title'] for topic in processor.load_topics(path_to_topics).values()])
+                quantizer.compareRecall({'hnswlib': full_index, 'compressed': compressed_index}, compressed_index.vectors, topic_vectors, k=1000)
+                # only the index that is searched stays loaded
+                del full_index, compressed_index
+
+            with profiler.stage('load_lookups'):
+                idx_to_docid = pickle.load(open(path_to_semantic_output + 'idx_to_passageid.p', 'rb'))
+                idx_to_passage = docstore.loadPassageStore(path_to_semantic_output + 'idx_to_passage')
+
+            # construct lazy reverse lookup for full document reranking,
+            # documents are only read from the passage store (and cached) when a reranker asks for them
+            with profiler.stage('docid_to_doc'):
+                docid_to_doc = docstore.LazyDocMap(idx_to_docid, idx_to_passage)
     
-    # initialize the bm25 searcher
-    pyserini_searcher = SimpleSearcher(path_to_idx_output)
+        # passage vectors grouped per document, for exact document scoring
+        doc_blocks = None
+        if exact_cutoff or expand:
+            with profiler.stage('load_doc_blocks'):
+                doc_blocks = docblocks.loadDocumentBlocks(path_to_semantic_output + 'doc_blocks')
+
+        # initialize the bm25 searcher
+        with profiler.stage('load_pyserini'):
+            pyserini_searcher = SimpleSearcher(path_to_idx_output)
 
-    # create the run directory (uncomment if first time)
-    #os.mkdir(path_to_run_output)
+        # create the run directory (uncomment if first time)
+        #os.mkdir(path_to_run_output)
 
-    # load the topics
-    topics = processor.load_topics(path_to_topics)
+        # load the topics
+        topics = processor.load_topics(path_to_topics)
 
-if evaluate:
+    if evaluate:
     
     
-    # Run BM25
-    bm25_run = searcher.bm25Search(pyserini_searcher, topics)
-    processor.writeRelevanceFile(bm25_run, path_to_run_output + 'run.bm25', 'bm25')
-    #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25')
-
-    # Run semantic search
-    semantic_run = searcher.semanticSearch(semantic_model, topics, hnswlib_index, idx_to_docid)
-    processor.writeRelevanceFile(semantic_run, path_to_run_output + 'run.semantic', 'semantic')
-    #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.semantic')
-
-
-    # Interpolate BM25 and semantic with alpha=0.7
-    interpolated_bm25_semantic = reranker.interpolate(path_to_run_output + 'run.bm25', path_to_run_output + 'run.semantic', 0.7)
-    processor.writeRelevanceFile(interpolated_bm25_semantic, path_to_run_output + 'run.bm25.semantic', 'bm25-0.7semantic')
-    #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25.semantic')
+        # Run BM25
+        with profiler.stage('run.bm25'):
+            bm25_run = searcher.bm25Search(pyserini_searcher, topics)
+            processor.writeRelevanceFile(bm25_run, path_to_run_output + 'run.bm25', 'bm25', binary=binary_runs)
+        #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25')
+
+        # Run semantic search
+        with profiler.stage('run.semantic'):
+            semantic_run = searcher.semanticSearch(semantic_model, topics, hnswlib_index, idx_to_docid)
+            processor.writeRelevanceFile(semantic_run, path_to_run_output + 'run.semantic', 'semantic', binary=binary_runs)
+        #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.semantic')
+
+
+        # Interpolate BM25 and semantic with alpha=0.7
+        with profiler.stage('run.bm25.semantic'):
+            interpolated_bm25_semantic = reranker.interpolate(path_to_run_output + 'run.bm25', path_to_run_output + 'run.semantic', 0.7)
+            processor.writeRelevanceFile(interpolated_bm25_semantic, path_to_run_output + 'run.bm25.semantic', 'bm25-0.7semantic', binary=binary_runs)
+        #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25.semantic')
    
 
-    # NN manifold rerank no cutoff
-    manifold_run = reranker.nn_pf_manifold(path_to_run_output + 'run.bm25.semantic', semantic_model, topics, hnswlib_index, idx_to_docid, docid_to_doc)
-    processor.writeRelevanceFile(manifold_run, path_to_run_output + 'run.bm25.semantic.manifold', 'manifold')
-    #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25.semantic.manifold')
+        # NN manifold rerank no cutoff
+        with profiler.stage('run.bm25.semantic.manifold'):
+            manifold_run = reranker.nn_pf_manifold(path_to_run_output + 'run.bm25.semantic', semantic_model, topics, hnswlib_index, idx_to_docid, docid_to_doc)
+            processor.writeRelevanceFile(manifold_run, path_to_run_output + 'run.bm25.semantic.manifold', 'manifold', binary=binary_runs)
+        #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25.semantic.manifold')
 
-    # NN manifold rerank with 10 cutoff
-    manifold_run_c10 = reranker.nn_pf_manifold(path_to_run_output + 'run.bm25.semantic', semantic_model, topics, hnswlib_index, idx_to_docid, docid_to_doc, rerank_cutoff=10)
-    processor.writeRelevanceFile(manifold_run_c10, path_to_run_output + 'run.bm25.semantic.manifold_c10', 'manifold-c10')
-    #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25.semantic.manifold_c10')
+        # NN manifold rerank with 10 cutoff
+        with profiler.stage('run.bm25.semantic.manifold_c10'):
+            manifold_run_c10 = reranker.nn_pf_manifold(path_to_run_output + 'run.bm25.semantic', semantic_model, topics, hnswlib_index, idx_to_docid, docid_to_doc, rerank_cutoff=10, doc_blocks=doc_blocks if exact_cutoff else None)
+            processor.writeRelevanceFile(manifold_run_c10, path_to_run_output + 'run.bm25.semantic.manifold_c10', 'manifold-c10', binary=binary_runs)
+        #os.system('../trec_eval/./trec_eval -m ndcg_cut.5 ' + path_to_qrels + ' ' +  path_to_run_output + 'run.bm25.semantic.manifold_c10')
 
         
-if view:
-    #given a run and an topic, print the top 10 most relevant documents
-    bm25_run_path = path_to_run_output + 'run.bm25'
-    semantic_run_path = path_to_run_output + 'run.semantic'
-    bm25_semantic_run_path = path_to_run_output + 'run.bm25.semantic'
-    manifold_run_path = path_to_run_output + 'run.bm25.semantic.manifold'
-    manifold_c10_run_path = path_to_run_output + 'run.bm25.semantic.manifold_c10'
-
-    topic = '91'
-    for path_to_run in [manifold_run_path]:
-         run = reranker.loadRun(path_to_run)[topic]
-         print(topics[topic]['title'])
-         for docid,_ in run[:5]:
-             print(docid_to_doc[docid])
+        if expand:
+            # BM25 with RM3 expansion, all topics in one batch
+            with profiler.stage('run.bm25.rm3'):
+                rm3_run = feedback.bm25Rm3Search(pyserini_searcher, topics)
+                processor.writeRelevanceFile(rm3_run, path_to_run_output + 'run.bm25.rm3', 'bm25-rm3', binary=binary_runs)
+
+            # Rocchio dense feedback from the top documents of the interpolated run
+            with profiler.stage('run.bm25.semantic.rocchio'):
+                rocchio_run = feedback.rocchioSearch(path_to_run_output + 'run.bm25.semantic', semantic_model, topics, hnswlib_index, idx_to_docid, doc_blocks)
+                processor.writeRelevanceFile(rocchio_run, path_to_run_output + 'run.bm25.semantic.rocchio', 'rocchio', binary=binary_runs)
+
+    if view:
+        #given a run and an topic, print the top 10 most relevant documents
+        bm25_run_path = path_to_run_output + 'run.bm25'
+        semantic_run_path = path_to_run_output + 'run.semantic'
+        bm25_semantic_run_path = path_to_run_output + 'run.bm25.semantic'
+        manifold_run_path = path_to_run_output + 'run.bm25.semantic.manifold'
+        manifold_c10_run_path = path_to_run_output + 'run.bm25.semantic.manifold_c10'
+
+        topic = '91'
+        for path_to_run in [manifold_run_path]:
+             run = reranker.loadRun(path_to_run)[topic]
+             print(topics[topic]['title'])
+             for docid,_ in run[:5]:
+                 print(docid_to_doc[docid])
+
+    if profile:
+        print('profile report written to', profiler.PROFILER.writeReport(path_to_profile_output))
@@ -1,7 +1,10 @@
 import re
 import json
+import profiler
+import runfile
 import xml.etree.ElementTree as ElementTree
 
+@profiler.timed('load_topics')
 def load_topics(path, onlyTitles=True):
     """
     Loads the topics
@@ -32,9 +35,57 @@ def load_topics(path, onlyTitles=True):
     return topics
 
 
+def iterArguments(path_to_corpus_file, chunk_size=2**20):
+    """
+    Streams the documents of the 'arguments' array of an args.me corpus file one at a time,
+    decoding them incrementally from a read buffer instead of json.load-ing the whole file
+
+    :param path_to_corpus_file: path to a single json corpus file
+    :type path_to_corpus_file: str
 
+    :param chunk_size: number of characters read at a time
+    :type chunk_size: int
 
-def writeRelevanceFile(run, output_path, run_name):
+    :rtype: generator
+    :returns: the argument dicts, in file order
+    """
+    decoder = json.JSONDecoder()
+    with open(path_to_corpus_file, 'r') as f:
+        # skip to the start of the arguments array
+        buffer = ''
+        while True:
+            match = re.search(r'"arguments"\s*:\s*\[', buffer)
+            if match:
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+        buffer = buffer[match.end():]
+        position = 0
+        while True:
+            # skip the separators between documents
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                doc, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the next document is not complete in the buffer yet
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield doc
+
+
+
+
+@profiler.timed('writeRelevanceFile')
+def writeRelevanceFile(run, output_path, run_name, binary=False, compress=False):
     """
     Writes a run to a relevance file, in trec-style format
 
@@ -47,15 +98,23 @@ def writeRelevanceFile(run, output_path, run_name):
     :param run_name: name of the run
     :type run_name: str
 
+    :param binary: write the binary run format instead (see runfile.py), reranker.loadRun reads both
+    :type binary: bool
+
+    :param compress: zlib compress the binary run
+    :type compress: bool
+
     :rtype: None
     :returns: Nothing
     """ 
+    if binary:
+        # the scores are stored as the values of their text, so both formats load to the same run
+        runfile.writeBinaryRun(run, output_path, run_name=run_name, compress=compress)
+        return
     with open(output_path, 'w') as f:
         for topic in run:
-            for i,doc in enumerate(run[topic]):
-                score = str(doc[1])
-                outstr = topic + " Q0 " + doc[0] + " " + str(i+1) + " " + score + ' ' + run_name + '\n'
-                f.write(outstr)
+            f.writelines(topic + " Q0 " + doc[0] + " " + str(i+1) + " " + str(doc[1]) + ' ' + run_name + '\n'
+                         for i,doc in enumerate(run[topic]))
 
 def createPassages(list_of_sentences, max_passage_words=200):
     """
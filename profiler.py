@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import functools
+import threading
+import contextlib
+import collections
+
+class Profiler:
+    """
+    Stage timers, counters and peak RSS sampling for a pipeline run.
+    Disabled by default, in which case stage() and count() cost next to nothing.
+    Stages can additionally be profiled with cProfile or a sampling profiler, only the outermost selected
+    stage of a thread is profiled (the stages nested in it are part of its profile).
+    Every thread has its own stage stack, a stage entered on a worker thread is reported from the top level.
+    Worker processes have their own copy of the profiler: their stages and counters are only kept
+    when the worker runs under collect() and the parent merges the returned record.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        # the stage stack of each thread, see stack
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # stage names to profile, '*' for all of them
+        self.profile_stages = set()
+        self.profile_mode = 'cprofile'
+        self.profile_dir = None
+        self.sample_interval = 0.01
+        self.started = None
+        self.peak_rss = 0
+        # id -> [peak rss] of every stage in progress (on any thread), raised by the sampler
+        self.open_peaks = {}
+        self.sampler = None
+
+    def enable(self, profile_stages=None, profile_mode='cprofile', profile_dir=None, sample_interval=0.01):
+        """
+        Starts recording
+
+        :param profile_stages: names of the stages to profile, '*' profiles every stage
+        :type profile_stages: list of str
+
+        :param profile_mode: 'cprofile' for deterministic profiling, 'sample' for the sampling profiler
+        :type profile_mode: str
+
+        :param profile_dir: if given, cProfile stats are dumped here as <stage>.prof
+        :type profile_dir: str
+
+        :param sample_interval: seconds between rss (and stack) samples
+        :type sample_interval: float
+
+        :rtype: None
+        :returns: Nothing
+        """
+        self.enabled = True
+        self.profile_stages = set(profile_stages or [])
+        self.profile_mode = profile_mode
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+        if self.started is None:
+            self.started = time.time()
+        self.peak_rss = max(self.peak_rss, currentRss())
+        if self.sampler is None or not self.sampler.is_alive():
+            self.sampler = threading.Thread(target=self.sampleRss, daemon=True)
+            self.sampler.start()
+
+    def disable(self):
+        self.enabled = False
+
+    @property
+    def stack(self):
+        """
+        The names of the stages the calling thread is in, outermost first
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def stageStats(self, path):
+        """
+        The stats of a stage path, created empty on first use. Callers hold the lock.
+        """
+        return self.stages.setdefault(path, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_rss_mb': 0.0})
+
+    def sampleRss(self):
+        while self.enabled:
+            rss = currentRss()
+            self.peak_rss = max(self.peak_rss, rss)
+            with self.lock:
+                for peak in self.open_peaks.values():
+                    peak[0] = max(peak[0], rss)
+            time.sleep(self.sample_interval)
+
+    def count(self, name, n=1):
+        """
+        Adds n to the named counter (queries, passages_encoded, knn_calls, docs_scored, ...)
+        """
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block, nested stages are reported as parent/child.
+        The stage's peak rss is the process peak while it runs, including what stages on other threads allocate.
+
+        :param name: the stage name
+        :type name: str
+        """
+        if not self.enabled:
+            yield
+            return
+        self.stack.append(name)
+        path = '/'.join(self.stack)
+        profile = self.startProfile(name)
+        peak = [currentRss()]
+        with self.lock:
+            self.open_peaks[id(peak)] = peak
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.stack.pop()
+            hottest = self.stopProfile(path, profile) if profile is not None else None
+            with self.lock:
+                del self.open_peaks[id(peak)]
+                stage_peak = max(peak[0], currentRss())
+                self.peak_rss = max(self.peak_rss, stage_peak)
+                stats = self.stageStats(path)
+                stats['calls'] += 1
+                stats['seconds'] += seconds
+                stats['max_seconds'] = max(stats['max_seconds'], seconds)
+                stats['peak_rss_mb'] = max(stats['peak_rss_mb'], stage_peak / 2 ** 20)
+                if hottest is not None:
+                    stats['profile'] = hottest
+
+    @contextlib.contextmanager
+    def collect(self):
+        """
+        Records the stages and counters of the enclosed block on their own, inside a pool worker process.
+        The worker returns the yielded record with its result and the parent passes it to merge,
+        otherwise they are lost with the worker's copy of the profiler.
+
+        :rtype: dict
+        :returns: the record, {'stages': .., 'counters': ..}, filled when the block exits
+        """
+        record = {'stages': collections.OrderedDict(), 'counters': collections.OrderedDict()}
+        if not self.enabled:
+            yield record
+            return
+        stages, counters, stack = self.stages, self.counters, self.stack
+        self.stages, self.counters, self.local.stack = record['stages'], record['counters'], []
+        try:
+            yield record
+        finally:
+            self.stages, self.counters, self.local.stack = stages, counters, stack
+
+    def merge(self, record):
+        """
+        Adds a record returned by a worker (see collect). Its stages are nested under the current stage,
+        and the seconds of the same stage in several workers are summed.
+
+        :param record: the worker's record
+        :type record: dict
+        """
+        if not self.enabled:
+            return
+        prefix = '/'.join(self.stack)
+        with self.lock:
+            for name, n in record['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for path, worker_stats in record['stages'].items():
+                stats = self.stageStats(prefix + '/' + path if prefix else path)
+                stats['calls'] += worker_stats['calls']
+                stats['seconds'] += worker_stats['seconds']
+                stats['max_seconds'] = max(stats['max_seconds'], worker_stats['max_seconds'])
+                stats['peak_rss_mb'] = max(stats['peak_rss_mb'], worker_stats['peak_rss_mb'])
+                if 'profile' in worker_stats:
+                    stats['profile'] = worker_stats['profile']
+
+    def startProfile(self, name):
+        """
+        Starts profiling a stage, unless it is not selected or a stage of this thread is already being profiled
+        (a second cProfile would replace the outer one)
+        """
+        if name not in self.profile_stages and '*' not in self.profile_stages:
+            return None
+        if getattr(self.local, 'profiling', False):
+            return None
+        self.local.profiling = True
+        if self.profile_mode == 'sample':
+            sampler = StackSampler(threading.get_ident(), self.sample_interval)
+            sampler.start()
+            return sampler
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # python 3.12+ allows one cProfile at a time, a stage on another thread is being profiled
+            self.local.profiling = False
+            return None
+        return profile
+
+    def stopProfile(self, path, profile, top=15):
+        """
+        Stops a stage profile and returns its hottest functions
+        """
+        self.local.profiling = False
+        if isinstance(profile, StackSampler):
+            return profile.stop(top)
+        profile.disable()
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(self.profile_dir, path.replace('/', '.') + '.prof'))
+        stats = pstats.Stats(profile)
+        hottest = sorted(stats.stats.items(), key=lambda x: x[1][3], reverse=True)[:top]
+        return [{'function': func[2] + ' (' + os.path.basename(func[0]) + ':' + str(func[1]) + ')',
+                 'calls': value[1], 'cumulative_seconds': value[3]} for func, value in hottest]
+
+    def report(self):
+        """
+        :rtype: dict
+        :returns: the structured report of the run so far
+        """
+        return {'started': self.started,
+                'wall_seconds': time.time() - self.started if self.started else 0.0,
+                'peak_rss_mb': max(self.peak_rss, currentRss()) / 2 ** 20,
+                'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                'stages': self.stages,
+                'counters': self.counters}
+
+    def writeReport(self, path_to_report_dir, run_name='run'):
+        """
+        Writes the report as <run_name>.<timestamp>.json, so runs can be compared over time
+
+        :param path_to_report_dir: directory where the reports are saved
+        :type path_to_report_dir: str
+
+        :param run_name: prefix of the report file
+        :type run_name: str
+
+        :rtype: str
+        :returns: path of the written report
+        """
+        os.makedirs(path_to_report_dir, exist_ok=True)
+        path = os.path.join(path_to_report_dir, run_name + '.' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+class StackSampler:
+    """
+    Sampling profiler: periodically records the innermost frames of one thread
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.total = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            # count each function once per sample, even if it is on the stack several times
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                seen.add(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+                frame = frame.f_back
+            self.samples.update(seen)
+            self.total += 1
+            time.sleep(self.interval)
+
+    def stop(self, top=15):
+        self.running = False
+        self.thread.join()
+        return [{'function': function, 'samples': samples, 'fraction': samples / float(self.total)}
+                for function, samples in self.samples.most_common(top)]
+
+
+def currentRss():
+    """
+    Current resident set size in bytes (falls back to the peak on platforms without /proc)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# The profiler shared by all modules of the pipeline
+PROFILER = Profiler()
+
+def stage(name):
+    return PROFILER.stage(name)
+
+def count(name, n=1):
+    PROFILER.count(name, n)
+
+def collect():
+    return PROFILER.collect()
+
+def merge(record):
+    PROFILER.merge(record)
+
+def timed(name):
+    """
+    Decorator that runs the whole function as a profiler stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
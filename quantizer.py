@@ -0,0 +1,404 @@
+import time
+import numpy as np
+
+class CompressedIndex:
+    """
+    Compressed (float16, int8 scalar or product quantized) passage vectors.
+    Search does an approximate pass over the compressed codes, then reranks a shortlist
+    with exact cosine against the float32 vectors, which are memory mapped so only the
+    shortlisted rows are read from disk.
+    With an inverted file (built with ivf_lists), the codes are grouped by their closest coarse
+    centroid and only the nprobe lists closest to a query are scanned, otherwise every code is scanned.
+    knn_query returns the same (labels, distances) as hnswlib, so it can be
+    passed wherever the hnswlib index is used.
+    """
+
+    def __init__(self, tier, codes, params, vectors, shortlist=1000, chunk_size=65536, nprobe=32):
+        """
+        :param tier: one of 'float16', 'int8' or 'pq'
+        :type tier: str
+
+        :param codes: the compressed vectors, one row per passage
+        :type codes: np.array
+
+        :param params: quantization parameters ('offset', 'scale' for int8, 'centroids' for pq)
+        :type params: dict
+
+        :param vectors: the exact, normalized float32 vectors (usually a memmap)
+        :type vectors: np.array
+
+        :param shortlist: number of candidates reranked with exact cosine per query
+        :type shortlist: int
+
+        :param chunk_size: number of rows scored at a time in the approximate pass
+        :type chunk_size: int
+
+        :param nprobe: number of inverted lists scanned per query (if the index has an inverted file)
+        :type nprobe: int
+        """
+        self.tier = tier
+        self.codes = codes
+        self.params = params
+        self.vectors = vectors
+        self.shortlist = shortlist
+        self.chunk_size = chunk_size
+        self.nprobe = nprobe
+
+    def set_ef(self, ef):
+        """
+        Mirrors hnswlib's set_ef, the shortlist plays the role of ef
+        """
+        self.shortlist = ef
+
+    def get_current_count(self):
+        return len(self.codes)
+
+    def approximateScores(self, queries, codes):
+        """
+        Approximate inner products between the queries and the given rows of the codes
+
+        :rtype: np.array
+        :returns: float32 array of shape (len(queries), len(codes))
+        """
+        if self.tier == 'float16':
+            return queries @ codes.astype(np.float32).T
+        elif self.tier == 'int8':
+            # x ~= offset + code * scale, so q.x = q.offset + (q * scale).code
+            scaled_queries = queries * self.params['scale']
+            return (queries @ self.params['offset'])[:, None] + scaled_queries @ codes.astype(np.float32).T
+        elif self.tier == 'pq':
+            # asymmetric distance computation, one lookup table per subspace
+            centroids = self.params['centroids']
+            num_subspaces, _, sub_dim = centroids.shape
+            scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+            for j in range(num_subspaces):
+                table = queries[:, j*sub_dim:(j+1)*sub_dim] @ centroids[j].T
+                scores += table[:, codes[:, j]]
+            return scores
+        raise ValueError('unknown tier: ' + str(self.tier))
+
+    def ivfCandidates(self, queries, shortlist):
+        """
+        Approximate pass over the nprobe inverted lists closest to each query
+        (more lists if those hold fewer than shortlist vectors).
+        Every probed list is scored once, against all the queries that probe it.
+
+        :rtype: list of np.array
+        :returns: the passage ids of the best shortlist candidates of each query
+        """
+        offsets = self.params['ivf_offsets']
+        sizes = offsets[1:] - offsets[:-1]
+        list_order = np.argsort(-(queries @ self.params['coarse_centroids'].T), axis=1)
+        list_queries = {}
+        for i, lists in enumerate(list_order):
+            num_lists = max(self.nprobe, int(np.searchsorted(np.cumsum(sizes[lists]), shortlist)) + 1)
+            for l in lists[:num_lists].tolist():
+                list_queries.setdefault(l, []).append(i)
+
+        rows = [[] for _ in queries]
+        scores = [[] for _ in queries]
+        for l, query_ids in list_queries.items():
+            list_scores = self.approximateScores(queries[query_ids], self.codes[offsets[l]:offsets[l+1]])
+            for j, i in enumerate(query_ids):
+                rows[i].append(np.arange(offsets[l], offsets[l+1]))
+                scores[i].append(list_scores[j])
+
+        candidate_ids = []
+        for query_rows, query_scores in zip(rows, scores):
+            query_rows = np.concatenate(query_rows)
+            if len(query_rows) > shortlist:
+                query_rows = query_rows[np.argpartition(-np.concatenate(query_scores), shortlist - 1)[:shortlist]]
+            candidate_ids.append(self.params['ivf_ids'][query_rows])
+        return candidate_ids
+
+    def flatCandidates(self, queries, shortlist):
+        """
+        Approximate pass over all the codes, chunk by chunk
+
+        :rtype: np.array
+        :returns: (len(queries), shortlist) passage ids of the best candidates
+        """
+        # keep the best shortlist candidates of every chunk, then of all chunks
+        candidate_ids = np.empty((len(queries), 0), dtype=np.int64)
+        candidate_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.codes), self.chunk_size):
+            end = min(start + self.chunk_size, len(self.codes))
+            scores = self.approximateScores(queries, self.codes[start:end])
+            if scores.shape[1] > shortlist:
+                top = np.argpartition(-scores, shortlist - 1, axis=1)[:, :shortlist]
+            else:
+                top = np.tile(np.arange(scores.shape[1]), (len(queries), 1))
+            candidate_ids = np.concatenate([candidate_ids, top + start], axis=1)
+            candidate_scores = np.concatenate([candidate_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            if candidate_ids.shape[1] > shortlist:
+                top = np.argpartition(-candidate_scores, shortlist - 1, axis=1)[:, :shortlist]
+                candidate_ids = np.take_along_axis(candidate_ids, top, axis=1)
+                candidate_scores = np.take_along_axis(candidate_scores, top, axis=1)
+        return candidate_ids
+
+    def knn_query(self, queries, k=1):
+        """
+        Approximate first pass over the codes (of the probed inverted lists), then exact cosine rerank of the shortlist
+
+        :param queries: query vectors
+        :type queries: np.array
+
+        :param k: number of neighbors to return
+        :type k: int
+
+        :rtype: tuple
+        :returns: (labels, distances) arrays of shape (len(queries), k), distances are 1 - cosine
+        """
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        shortlist = min(max(self.shortlist, k), len(self.codes))
+        if 'ivf_offsets' in self.params:
+            candidate_ids = self.ivfCandidates(queries, shortlist)
+        else:
+            candidate_ids = self.flatCandidates(queries, shortlist)
+
+        labels = np.empty((len(queries), k), dtype=np.uint64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        for i, query in enumerate(queries):
+            # sorted ids keep the memmap reads sequential
+            ids = np.sort(candidate_ids[i])
+            sims = np.asarray(self.vectors[ids], dtype=np.float32) @ query
+            order = np.argsort(-sims)[:k]
+            labels[i] = ids[order]
+            distances[i] = 1 - sims[order]
+        return labels, distances
+
+    def save(self, path_prefix):
+        """
+        Saves the codes and quantization parameters (the exact vectors are saved separately)
+
+        :param path_prefix: prefix of the output files
+        :type path_prefix: str
+
+        :rtype: None
+        :returns: Nothing
+        """
+        np.save(path_prefix + '.codes.npy', self.codes)
+        np.savez(path_prefix + '.params.npz', tier=np.array(self.tier), **self.params)
+
+    def nbytes(self):
+        """
+        Memory held by the compressed tier (the memmapped exact vectors are not counted)
+        """
+        return self.codes.nbytes + sum(value.nbytes for value in self.params.values())
+
+
+def normalize(vectors):
+    """
+    L2-normalizes the rows of vectors, so inner products are cosine similarities
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def trainKMeans(data, num_centroids, iterations=20, seed=0):
+    """
+    Plain Lloyd's k-means, used to train the product quantization codebooks
+
+    :param data: training vectors
+    :type data: np.array
+
+    :param num_centroids: number of clusters
+    :type num_centroids: int
+
+    :param iterations: number of assignment/update rounds
+    :type iterations: int
+
+    :rtype: np.array
+    :returns: float32 array of shape (num_centroids, dim)
+    """
+    rng = np.random.RandomState(seed)
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), num_centroids, replace=len(data) < num_centroids)].copy()
+    for _ in range(iterations):
+        assignment = assignCodes(data, centroids)
+        # members of a cluster are contiguous after sorting, so all the cluster sums are one reduceat
+        counts = np.bincount(assignment, minlength=num_centroids)
+        filled = np.nonzero(counts)[0]
+        starts = (np.cumsum(counts) - counts)[filled]
+        centroids[filled] = np.add.reduceat(data[np.argsort(assignment, kind='stable')], starts, axis=0) / counts[filled, None]
+        # re-seed empty clusters
+        empty = np.nonzero(counts == 0)[0]
+        centroids[empty] = data[rng.randint(len(data), size=len(empty))]
+    return centroids.astype(np.float32)
+
+
+def assignCodes(data, centroids, chunk_size=4096):
+    """
+    Index of the closest centroid for every row of data, in chunks so the distance matrix stays small
+    """
+    # squared euclidean distance, dropping the constant |x|^2 term
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[start:start+chunk_size], dtype=np.float32)
+        assignment[start:start+chunk_size] = np.argmin(centroid_norms - 2 * chunk @ centroids.T, axis=1)
+    return assignment
+
+
+def buildCompressedIndex(vectors, tier='int8', pq_subspaces=96, pq_centroids=256, pq_train_size=50000, chunk_size=65536,
+                         ivf_lists=None, ivf_train_size=20000):
+    """
+    Compresses the passage vectors into the requested tier
+
+    :param vectors: normalized float32 passage vectors, row i is passage i
+    :type vectors: np.array
+
+    :param tier: 'float16' (2x smaller), 'int8' (4x smaller) or 'pq' (dim*4/pq_subspaces smaller)
+    :type tier: str
+
+    :param pq_subspaces: number of subspaces for product quantization, must divide the dimension
+    :type pq_subspaces: int
+
+    :param pq_centroids: number of centroids per subspace (at most 256, codes are uint8)
+    :type pq_centroids: int
+
+    :param pq_train_size: number of vectors sampled to train the codebooks
+    :type pq_train_size: int
+
+    :param ivf_lists: number of inverted lists (coarse centroids), None scans every code per query
+    :type ivf_lists: int
+
+    :param ivf_train_size: number of vectors sampled to train the coarse centroids
+    :type ivf_train_size: int
+
+    :rtype: CompressedIndex
+    :returns: the compressed index
+    """
+    params = {}
+    if tier == 'float16':
+        codes = vectors.astype(np.float16)
+    elif tier == 'int8':
+        # per dimension scalar quantization into 256 levels
+        offset = vectors.min(axis=0).astype(np.float32)
+        scale = ((vectors.max(axis=0) - offset) / 255).astype(np.float32)
+        scale[scale == 0] = 1
+        codes = np.empty(vectors.shape, dtype=np.uint8)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = (vectors[start:start+chunk_size] - offset) / scale
+            codes[start:start+chunk_size] = np.clip(np.rint(chunk), 0, 255)
+        params = {'offset': offset, 'scale': scale}
+    elif tier == 'pq':
+        dim = vectors.shape[1]
+        if dim % pq_subspaces != 0:
+            raise ValueError('pq_subspaces must divide the vector dimension')
+        sub_dim = dim // pq_subspaces
+        rng = np.random.RandomState(0)
+        sample = vectors[np.sort(rng.choice(len(vectors), min(pq_train_size, len(vectors)), replace=False))]
+        centroids = np.stack([trainKMeans(np.asarray(sample[:, j*sub_dim:(j+1)*sub_dim], dtype=np.float32), pq_centroids)
+                              for j in range(pq_subspaces)])
+        codes = np.empty((len(vectors), pq_subspaces), dtype=np.uint8)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = np.asarray(vectors[start:start+chunk_size], dtype=np.float32)
+            for j in range(pq_subspaces):
+                codes[start:start+chunk_size, j] = assignCodes(chunk[:, j*sub_dim:(j+1)*sub_dim], centroids[j])
+        params = {'centroids': centroids}
+    else:
+        raise ValueError('unknown tier: ' + str(tier))
+
+    if ivf_lists:
+        # group the codes by their closest coarse centroid, each inverted list is then one contiguous slice
+        rng = np.random.RandomState(1)
+        sample = vectors[np.sort(rng.choice(len(vectors), min(ivf_train_size, len(vectors)), replace=False))]
+        coarse_centroids = normalize(trainKMeans(sample, min(ivf_lists, len(vectors)), iterations=10))
+        assignment = assignCodes(vectors, coarse_centroids)
+        ivf_ids = np.argsort(assignment, kind='stable')
+        codes = codes[ivf_ids]
+        ivf_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(coarse_centroids)))]).astype(np.int64)
+        params.update({'coarse_centroids': coarse_centroids, 'ivf_offsets': ivf_offsets, 'ivf_ids': ivf_ids})
+    return CompressedIndex(tier, codes, params, vectors, chunk_size=chunk_size)
+
+
+def loadCompressedIndex(path_prefix, path_to_vectors, shortlist=1000, nprobe=32):
+    """
+    Loads a compressed index saved with CompressedIndex.save
+
+    :param path_prefix: prefix the index was saved under
+    :type path_prefix: str
+
+    :param path_to_vectors: path to the exact float32 vectors (.npy), memory mapped
+    :type path_to_vectors: str
+
+    :param shortlist: number of candidates reranked with exact cosine per query
+    :type shortlist: int
+
+    :param nprobe: number of inverted lists scanned per query (if the index has an inverted file)
+    :type nprobe: int
+
+    :rtype: CompressedIndex
+    :returns: the compressed index
+    """
+    codes = np.load(path_prefix + '.codes.npy')
+    saved = np.load(path_prefix + '.params.npz')
+    tier = str(saved['tier'])
+    params = {key: saved[key] for key in saved.files if key != 'tier'}
+    vectors = np.load(path_to_vectors, mmap_mode='r')
+    return CompressedIndex(tier, codes, params, vectors, shortlist=shortlist, nprobe=nprobe)
+
+
+def vectorsFromIndex(hnswlib_index, batch_size=10000):
+    """
+    Reads the (already normalized, for the cosine space) vectors back out of an existing hnswlib index,
+    so an index built before the vectors were saved does not need to be re-encoded
+
+    :param hnswlib_index: the hnswlib passage index, labels are assumed to be 0..n-1
+    :type hnswlib_index: hnswlib.Index
+
+    :rtype: np.array
+    :returns: float32 array, row i is passage i
+    """
+    count = hnswlib_index.get_current_count()
+    vectors = np.empty((count, hnswlib_index.dim), dtype=np.float32)
+    for start in range(0, count, batch_size):
+        end = min(start + batch_size, count)
+        vectors[start:end] = np.array(hnswlib_index.get_items(list(range(start, end))), dtype=np.float32)
+    return vectors
+
+
+def compareRecall(indices, vectors, queries, k=100, chunk_size=65536):
+    """
+    Compares the recall@k of several indices against exact brute force cosine search
+
+    :param indices: dict of index name to index (anything with knn_query, e.g. hnswlib or CompressedIndex)
+    :type indices: dict
+
+    :param vectors: the exact, normalized float32 passage vectors
+    :type vectors: np.array
+
+    :param queries: the query vectors, e.g. the encoded topic titles
+    :type queries: np.array
+
+    :param k: the number of neighbors compared
+    :type k: int
+
+    :rtype: dict
+    :returns: dict of index name to {'recall': recall@k, 'seconds': query time}
+    """
+    queries = normalize(np.asarray(queries, dtype=np.float32))
+
+    # exact ground truth, chunked so the full similarity matrix is never held
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(vectors), chunk_size):
+        scores = queries @ np.asarray(vectors[start:start+chunk_size], dtype=np.float32).T
+        best_ids = np.concatenate([best_ids, np.tile(np.arange(start, start + scores.shape[1]), (len(queries), 1))], axis=1)
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        if best_ids.shape[1] > k:
+            top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_ids = np.take_along_axis(best_ids, top, axis=1)
+            best_scores = np.take_along_axis(best_scores, top, axis=1)
+
+    results = {}
+    for name, index in indices.items():
+        start = time.time()
+        labels, _ = index.knn_query(queries, k=k)
+        seconds = time.time() - start
+        hits = sum(len(set(labels[i].tolist()) & set(best_ids[i].tolist())) for i in range(len(queries)))
+        results[name] = {'recall': hits / float(len(queries) * k), 'seconds': seconds}
+        print(name, 'recall@' + str(k), round(results[name]['recall'], 4), 'in', round(seconds, 3), 's')
+    return results
@@ -1,15 +1,23 @@
 import math
+import numpy as np
+import profiler
+import runfile
 
+@profiler.timed('loadRun')
 def loadRun(path_to_run):
     """
-    Loads run into dict, where key is topic and value is array of (docid, score) tuples
+    Loads run into dict, where key is topic and value is array of (docid, score) tuples.
+    Both trec-style runs and binary runs (runfile.py) are accepted, a binary run is returned as the
+    memory mapped runfile.BinaryRun (read only), whose lists are built per topic on access.
 
     :param path_to_run: the path to the run
     :type path_to_run: str
 
-    :rtype: dict
+    :rtype: dict or runfile.BinaryRun
     :returns: dict of run
     """
+    if runfile.isBinaryRun(path_to_run):
+        return runfile.loadBinaryRun(path_to_run)
     run = {}
     with open(path_to_run, 'r') as f:
         for line in f:
@@ -22,6 +30,7 @@ def loadRun(path_to_run):
             run[topic].append((docid, score))
     return run
 
+@profiler.timed('crossEncode')
 def crossEncode(path_to_run, cross_encoder, topics, docid_to_doc, topk=20):
     """
     Reranks topk documents using cross-encoder
@@ -45,6 +54,7 @@ def crossEncode(path_to_run, cross_encoder, topics, docid_to_doc, topk=20):
     :returns: dict of reranked run
     """
     run = loadRun(path_to_run)
+    cross_encoded_runs = {}
     for topic in run:
         query = topics[topic]['title']
         print(query)
@@ -55,13 +65,15 @@ def crossEncode(path_to_run, cross_encoder, topics, docid_to_doc, topk=20):
             try:
                 for passage in docid_to_doc[docid]:
                     doc_score = max(doc_score, cross_encoder.predict([(query, passage)])[0])
+                profiler.count('passages_cross_encoded', len(docid_to_doc[docid]))
+                profiler.count('docs_scored')
 
                 reranked_run.append((docid, doc_score))
             except Exception as e:
                 print(e)
         sorted_run = sorted(reranked_run, reverse=True, key=lambda x: x[1])
-        run[topic] = sorted_run
-    return run
+        cross_encoded_runs[topic] = sorted_run
+    return cross_encoded_runs
 
 def calcSigma(dist, k, rho):
     """
@@ -106,7 +118,7 @@ def calcSigma(dist, k, rho):
         psum = sum([math.exp((-1 * max(0, dist_i - rho)) / mid) for dist_i in dist])
 
 
-def nn_pf_manifold(path_to_run, model, topics, index, idx_to_docid, docid_to_doc, rel_docs=3, k=50, rerank_cutoff=None):
+def nn_pf_manifold(path_to_run, model, topics, index, idx_to_docid, docid_to_doc, rel_docs=3, k=50, rerank_cutoff=None, doc_blocks=None):
     """
     Nearest neighbor pseudo feedback but approximates the manifold like UMAP
     :param path_to_run: path to the run to rerank
@@ -137,19 +149,42 @@ def nn_pf_manifold(path_to_run, model, topics, index, idx_to_docid, docid_to_doc
                           path_to_run up to rerank_cutoff are considered
     :type rerank_cutoff: None or int
 
+    :param doc_blocks: if given, the feedback passage vectors are looked up instead of re-encoded,
+                       and with rerank_cutoff every document up to the cutoff gets an exact manifold score
+    :type doc_blocks: None or docblocks.DocumentBlocks
+
     :rtype: dict
     :returns: dict of reranked run
     """
+    return manifoldRerank(loadRun(path_to_run), model, topics, index, idx_to_docid, docid_to_doc, rel_docs=rel_docs, k=k, rerank_cutoff=rerank_cutoff, doc_blocks=doc_blocks)
 
-    run = loadRun(path_to_run)
+@profiler.timed('manifoldRerank')
+def manifoldRerank(run, model, topics, index, idx_to_docid, docid_to_doc, rel_docs=3, k=50, rerank_cutoff=None, doc_blocks=None):
+    """
+    Same as nn_pf_manifold, but takes the run itself instead of a path to it
+
+    :param run: dict where keys are topics and values are sorted (docid, score) lists
+    :type run: dict
+
+    :rtype: dict
+    :returns: dict of reranked run
+    """
     manifold_runs = {}
     for topic in run:
         manifold_runs[topic] = []
-        passages = []
-        for docid,_ in run[topic][:rel_docs]:
-            passages += docid_to_doc[docid]
-        encoded_passages = model.encode(passages)
+        if doc_blocks is not None:
+            encoded_passages = doc_blocks.feedbackVectors([docid for docid,_ in run[topic][:rel_docs]])
+        else:
+            passages = []
+            for docid,_ in run[topic][:rel_docs]:
+                passages += docid_to_doc[docid]
+            encoded_passages = model.encode(passages)
+            profiler.count('passages_encoded', len(passages))
         labels, distances = index.knn_query(encoded_passages, k=k)
+        profiler.count('knn_calls')
+        if rerank_cutoff and doc_blocks is not None:
+            manifold_runs[topic] = exactManifoldCutoff(run[topic], encoded_passages, distances, k, rerank_cutoff, doc_blocks)
+            continue
         document_sums = {}
         for i in range(len(encoded_passages)):
             # Ignore the distance to the passage itself
@@ -176,6 +211,7 @@ def nn_pf_manifold(path_to_run, model, topics, index, idx_to_docid, docid_to_doc
         # create list sorted list, and note we don't normalize by length
         # assume longer documents have stronger arguments
         sorted_document_sums = sorted([(docid, document_sums[docid]) for docid in document_sums], reverse=True, key=lambda x: x[1])
+        profiler.count('docs_scored', len(sorted_document_sums))
         if rerank_cutoff:
             top_orig_docs = [docid[0] for docid in run[topic][:rerank_cutoff]]
             for doc in sorted_document_sums:
@@ -188,7 +224,138 @@ def nn_pf_manifold(path_to_run, model, topics, index, idx_to_docid, docid_to_doc
             manifold_runs[topic] = sorted_document_sums[:1000]
     return manifold_runs
 
-def nn_pf(path_to_run, model, topics, index, idx_to_docid, docid_to_doc, rel_docs=5, k=20):
+def exactManifoldCutoff(topic_run, feedback_vectors, distances, k, rerank_cutoff, doc_blocks):
+    """
+    Helper function for manifoldRerank with a cutoff and a document block store.
+    rho and sigma of each feedback passage still come from its knn distances,
+    but the edge weights are computed exactly against every passage of the top rerank_cutoff documents,
+    so documents outside the knn neighborhood are scored too.
+
+    :param topic_run: sorted (docid, score) list of the topic
+    :type topic_run: list
+
+    :param feedback_vectors: the passage vectors of the feedback documents
+    :type feedback_vectors: np.array
+
+    :param distances: the knn distances of the feedback vectors
+    :type distances: np.array
+
+    :rtype: list
+    :returns: the reranked (docid, score) list, the reranked documents stay above the rest of the run
+    """
+    rhos = []
+    sigmas = []
+    for i in range(len(feedback_vectors)):
+        passage_distances = distances[i][1:]
+        rho = min(passage_distances)
+        sigma = calcSigma(passage_distances, k-1, rho)
+        if sigma:
+            rhos.append(rho)
+            sigmas.append(sigma)
+        else:
+            # same as the knn version, such a passage does not contribute
+            print('Warning: the calculated sigma approached 0:', passage_distances)
+            rhos.append(0.0)
+            sigmas.append(np.inf)
+    rhos = np.array(rhos, dtype=np.float32)[:, None]
+    sigmas = np.array(sigmas, dtype=np.float32)[:, None]
+
+    found, passages, segments, _ = doc_blocks.gather([docid for docid,_ in topic_run[:rerank_cutoff]])
+    if not found:
+        return topic_run[:1000]
+    norms = np.linalg.norm(feedback_vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    passage_distances = 1 - (feedback_vectors / norms) @ passages.T
+    edge_weights = np.exp(-np.maximum(0, passage_distances - rhos) / sigmas)
+    edge_weights[np.isinf(sigmas[:, 0])] = 0
+    doc_scores = np.add.reduceat(edge_weights.sum(axis=0), segments)
+    profiler.count('docs_scored', len(found))
+
+    reranked = sorted(zip(found, doc_scores.tolist()), reverse=True, key=lambda x: x[1])
+    return combineReranked(reranked, topic_run[:rerank_cutoff], topic_run[rerank_cutoff:])[:1000]
+
+def placeAbove(head, tail):
+    """
+    Concatenates two ranked lists, shifting the tail scores (keeping their order and gaps)
+    so that every tail document scores below every head document
+
+    :param head: sorted (docid, score) list that must stay on top
+    :type head: list
+
+    :param tail: sorted (docid, score) list
+    :type tail: list
+
+    :rtype: list
+    :returns: the combined (docid, score) list
+    """
+    if not head or not tail:
+        return head + tail
+    shift = max(0, tail[0][1] - head[-1][1] + 1)
+    return head + [(docid, score - shift) for docid, score in tail]
+
+def combineReranked(reranked, head, tail):
+    """
+    Combines the rescored head of a run with the rest of it.
+    Head documents that could not be rescored (no passage vectors, e.g. every sentence was filtered out
+    by createSentences) are kept with their original order and score gaps, below the rescored documents
+    and above the tail
+
+    :param reranked: sorted (docid, score) list of the rescored head documents
+    :type reranked: list
+
+    :param head: the original (docid, score) list of the head
+    :type head: list
+
+    :param tail: sorted (docid, score) list of the documents after the head
+    :type tail: list
+
+    :rtype: list
+    :returns: the combined (docid, score) list
+    """
+    rescored = {docid for docid,_ in reranked}
+    unscored = [(docid, score) for docid, score in head if docid not in rescored]
+    return placeAbove(reranked, placeAbove(unscored, tail))
+
+@profiler.timed('exactRerank')
+def exactRerank(path_to_run, model, topics, doc_blocks, rerank_cutoff=1000, agg='max'):
+    """
+    Scores the top rerank_cutoff documents of a run exactly against the topic title embedding,
+    using the passage vectors in the document block store (no knn search, so no recall loss)
+
+    :param path_to_run: path to the run to rerank
+    :type path_to_run: str
+
+    :param model: the semantic encoder
+    :type model: SentenceTransformer
+
+    :param topics: dict of the topics
+    :type topics: dict
+
+    :param doc_blocks: the document block store
+    :type doc_blocks: docblocks.DocumentBlocks
+
+    :param rerank_cutoff: number of documents per topic to rerank
+    :type rerank_cutoff: int
+
+    :param agg: 'max' or 'mean' over the passages of a document
+    :type agg: str
+
+    :rtype: dict
+    :returns: dict of reranked run
+    """
+    run = loadRun(path_to_run)
+    topic_nums = [topic for topic in run]
+    encoded_queries = model.encode([topics[topic]['title'] for topic in topic_nums])
+    reranked_run = {}
+    for topic, query_vector in zip(topic_nums, encoded_queries):
+        scored = doc_blocks.score(query_vector, [docid for docid,_ in run[topic][:rerank_cutoff]], agg=agg)
+        profiler.count('docs_scored', len(scored))
+        reranked = sorted(scored, reverse=True, key=lambda x: x[1])
+        reranked_run[topic] = combineReranked(reranked, run[topic][:rerank_cutoff], run[topic][rerank_cutoff:])[:1000]
+    return reranked_run
+
+@profiler.timed('nn_pf')
+def nn_pf(path_to_run, model, topics, index, idx_to_docid, docid_to_doc, rel_docs=5, k=20, doc_blocks=None):
     """
     Nearest neighbor pseudo feedback
     Assumes the top rel_docs are relevant, then does a k-nn search for all passages in those documents,
@@ -218,21 +385,28 @@ def nn_pf(path_to_run, model, topics, index, idx_to_docid, docid_to_doc, rel_doc
     :param k: the number of nearest neighbors to return
     :type k: int
 
+    :param doc_blocks: if given, the feedback passage vectors are looked up instead of re-encoded
+    :type doc_blocks: None or docblocks.DocumentBlocks
+
     :rtype: dict
     :returns: dict of reranked run
     """
 
 
     run = loadRun(path_to_run)
+    nn_pf_runs = {}
     for topic in run:
-        passages = []
-        for docid,_ in run[topic][:rel_docs]:
-            passages += docid_to_doc[docid]
-
-
-        encoded_passages = model.encode(passages)
+        if doc_blocks is not None:
+            encoded_passages = doc_blocks.feedbackVectors([docid for docid,_ in run[topic][:rel_docs]])
+        else:
+            passages = []
+            for docid,_ in run[topic][:rel_docs]:
+                passages += docid_to_doc[docid]
+            encoded_passages = model.encode(passages)
+            profiler.count('passages_encoded', len(passages))
         scores = {}
         labels, distances = index.knn_query(encoded_passages, k=k)
+        profiler.count('knn_calls')
         for i in range(len(encoded_passages)):
             for docidx, dist in zip(labels[i], distances[i]):
                 docid = idx_to_docid[docidx]
@@ -240,8 +414,8 @@ def nn_pf(path_to_run, model, topics, index, idx_to_docid, docid_to_doc, rel_doc
                     scores[docid] = 0
                 scores[docid] += 1-dist
         sorted_scores = sorted([(docidx, scores[docidx]) for docidx in scores], reverse=True, key=lambda x: x[1])
-        run[topic] = sorted_scores
-    return run
+        nn_pf_runs[topic] = sorted_scores
+    return nn_pf_runs
 
 
 # interpolate runs
@@ -261,8 +435,25 @@ def interpolate(path_to_run1, path_to_run2, alpha):
     :rtype: dict
     :returns: dict of reranked run
     """
-    run1 = loadRun(path_to_run1)
-    run2 = loadRun(path_to_run2)
+    return interpolateRuns(loadRun(path_to_run1), loadRun(path_to_run2), alpha)
+
+@profiler.timed('interpolateRuns')
+def interpolateRuns(run1, run2, alpha):
+    """
+    Same as interpolate, but takes the runs themselves instead of paths to them
+
+    :param run1: dict where keys are topics and values are (docid, score) lists
+    :type run1: dict
+
+    :param run2: dict where keys are topics and values are (docid, score) lists
+    :type run2: dict
+
+    :param alpha: how much of the second run should be added to the first run
+    :type alpha: float
+
+    :rtype: dict
+    :returns: dict of reranked run
+    """
     interpolated_runs = {}
     for topic in run1:
         # make run into dict
@@ -276,6 +467,7 @@ def interpolate(path_to_run1, path_to_run2, alpha):
         interpolated_topic_run = sorted([(doc, interpolated_topic_run[doc]) for doc in interpolated_topic_run], reverse=True, key=lambda x:x[1])
             
         interpolated_runs[topic] = interpolated_topic_run[:1000]
+        profiler.count('docs_scored', len(interpolated_topic_run))
     return interpolated_runs
 
         
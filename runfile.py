@@ -0,0 +1,276 @@
+import json
+import zlib
+import struct
+import collections.abc
+import numpy as np
+
+# File layout: MAGIC, uint64 header length, json header, then the array blocks
+# (docid dictionary, topic offsets, docid codes, scores, optionally the score texts), each aligned to 8 bytes
+MAGIC = b'TRUNBIN1'
+ALIGNMENT = 8
+
+class BinaryRun(collections.abc.Mapping):
+    """
+    A run loaded from the binary run format, behaves like the dict returned by loadRun
+    (topic -> list of (docid, score)), but the arrays are memory mapped and the
+    (docid, score) lists are only built (once) for the topics that are accessed.
+    topicArrays gives the raw codes and scores of a topic without building any tuples.
+    It is read only, rerankers build new runs from it.
+    """
+
+    def __init__(self, run_name, topics, docids, offsets, codes, scores, score_format='float64', score_texts=None):
+        self.run_name = run_name
+        self.topics = topics
+        self.docids = docids
+        self.offsets = offsets
+        self.codes = codes
+        # float64 values of the score texts, the same floats as parsing the trec-style text
+        self.scores = scores
+        # how the scores are written back as text (see scoreFormat), 'text' uses score_texts
+        self.score_format = score_format
+        # newline separated text of every score, only stored when no score format gives the text back
+        self.score_texts = score_texts
+        self.topic_to_idx = {topic: i for i, topic in enumerate(topics)}
+        self.built = {}
+
+    def topicArrays(self, topic):
+        """
+        :rtype: tuple
+        :returns: (int32 docid codes, float64 scores) of the topic, as array views
+        """
+        i = self.topic_to_idx[topic]
+        return self.codes[self.offsets[i]:self.offsets[i+1]], self.scores[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, topic):
+        if topic not in self.built:
+            codes, scores = self.topicArrays(topic)
+            self.built[topic] = list(zip(map(self.docids.__getitem__, codes.tolist()), scores.tolist()))
+        return self.built[topic]
+
+    def __iter__(self):
+        return iter(self.topics)
+
+    def __len__(self):
+        return len(self.topics)
+
+    def scoreTexts(self, topic):
+        """
+        :rtype: list of str
+        :returns: the text of every score of the topic, as it was in the trec-style run
+        """
+        codes, scores = self.topicArrays(topic)
+        if self.score_format == 'text':
+            if not isinstance(self.score_texts, list):
+                self.score_texts = bytes(self.score_texts).decode('utf-8').split('\n')
+            i = self.topic_to_idx[topic]
+            return self.score_texts[self.offsets[i]:self.offsets[i+1]]
+        return [formatScore(score, self.score_format) for score in scores.tolist()]
+
+
+def formatScore(score, score_format):
+    """
+    Writes a float64 score as text, the way a score of the given format was written (str of the original value)
+    """
+    if score_format == 'float32':
+        return str(np.float32(score))
+    if score_format == 'int64':
+        return str(int(score))
+    return str(score)
+
+
+def scoreFormat(score_texts):
+    """
+    Picks the score format whose text is given back exactly from the float64 value of the text
+    (float32 for semantic scores, float64 for scores that were python floats, int64 for counts)
+
+    :rtype: str
+    :returns: the score format, 'text' if there is none (e.g. a run mixing integer and float scores)
+    """
+    for score_format in ['float64', 'float32', 'int64']:
+        try:
+            if all(formatScore(float(text), score_format) == text for text in score_texts):
+                return score_format
+        except (ValueError, OverflowError):
+            continue
+    return 'text'
+
+
+def writeBinaryRun(run, output_path, run_name='', compress=False, score_texts=None):
+    """
+    Writes a run in the binary run format.
+    The scores are stored as the float64 values of their text, with the format to write them back as text,
+    or with the texts themselves if no format gives them back.
+
+    :param run: dict where keys are topics and values are sorted (docid, score) lists
+    :type run: dict
+
+    :param output_path: name of the file to write the results
+    :type output_path: str
+
+    :param run_name: name of the run
+    :type run_name: str
+
+    :param compress: zlib compress the arrays (smaller, but then loading cannot memory map them)
+    :type compress: bool
+
+    :param score_texts: text of every score in run order (as in the trec-style file), default str of every score
+    :type score_texts: list of str
+
+    :rtype: None
+    :returns: Nothing
+    """
+    topics = [topic for topic in run]
+    if score_texts is None:
+        score_texts = [str(score) for topic in topics for _, score in run[topic]]
+    score_format = scoreFormat(score_texts)
+    docid_to_code = {}
+    offsets = np.zeros(len(topics) + 1, dtype=np.int64)
+    for i, topic in enumerate(topics):
+        offsets[i+1] = offsets[i] + len(run[topic])
+    codes = np.empty(offsets[-1], dtype=np.int32)
+    for i, topic in enumerate(topics):
+        start = offsets[i]
+        for j, (docid, _) in enumerate(run[topic]):
+            codes[start + j] = docid_to_code.setdefault(docid, len(docid_to_code))
+    scores = np.array([float(text) for text in score_texts], dtype=np.float64)
+
+    blocks = [('docids', '\n'.join(docid_to_code).encode('utf-8')),
+              ('offsets', offsets.tobytes()),
+              ('codes', codes.tobytes()),
+              ('scores', scores.tobytes())]
+    if score_format == 'text':
+        blocks.append(('score_texts', '\n'.join(score_texts).encode('utf-8')))
+    header = {'run_name': run_name,
+              'topics': topics,
+              'num_docids': len(docid_to_code),
+              'score_format': score_format,
+              'compression': 'zlib' if compress else None,
+              'blocks': {}}
+    if compress:
+        blocks = [(name, zlib.compress(data)) for name, data in blocks]
+
+    # block positions are relative to the end of the (padded) header
+    position = 0
+    for name, data in blocks:
+        header['blocks'][name] = [position, len(data)]
+        position += len(data) + (-len(data)) % ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * ((-(len(MAGIC) + 8 + len(header_bytes))) % ALIGNMENT)
+
+    with open(output_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, data in blocks:
+            f.write(data)
+            f.write(b'\0' * ((-len(data)) % ALIGNMENT))
+
+
+def isBinaryRun(path_to_run):
+    """
+    :rtype: bool
+    :returns: True if the file is in the binary run format
+    """
+    with open(path_to_run, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def loadBinaryRun(path_to_run):
+    """
+    Loads a binary run. Uncompressed arrays are memory mapped (zero copy),
+    compressed ones are decompressed into memory.
+
+    :param path_to_run: the path to the run
+    :type path_to_run: str
+
+    :rtype: BinaryRun
+    :returns: the run
+    """
+    with open(path_to_run, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path_to_run + ' is not a binary run file')
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = len(MAGIC) + 8 + header_length
+
+    if header['compression'] == 'zlib':
+        with open(path_to_run, 'rb') as f:
+            def block(name):
+                position, length = header['blocks'][name]
+                f.seek(data_start + position)
+                return zlib.decompress(f.read(length))
+            docids = block('docids')
+            offsets = np.frombuffer(block('offsets'), dtype=np.int64)
+            codes = np.frombuffer(block('codes'), dtype=np.int32)
+            scores = np.frombuffer(block('scores'), dtype=np.float64)
+            score_texts = block('score_texts') if 'score_texts' in header['blocks'] else None
+    else:
+        data = np.memmap(path_to_run, dtype=np.uint8, mode='r')
+        def block(name, dtype):
+            position, length = header['blocks'][name]
+            return data[data_start + position:data_start + position + length].view(dtype)
+        docids = block('docids', np.uint8).tobytes()
+        offsets = block('offsets', np.int64)
+        codes = block('codes', np.int32)
+        scores = block('scores', np.float64)
+        score_texts = block('score_texts', np.uint8) if 'score_texts' in header['blocks'] else None
+
+    docids = docids.decode('utf-8').split('\n') if header['num_docids'] else []
+    return BinaryRun(header['run_name'], header['topics'], docids, offsets, codes, scores,
+                     score_format=header['score_format'], score_texts=score_texts)
+
+
+def trecToBinary(path_to_trec, output_path, compress=False):
+    """
+    Converts a trec-style run file into the binary format.
+    The score texts are kept (as a score format or the texts themselves) so that binaryToTrec gives back the same text.
+
+    :param path_to_trec: the path to the trec-style run
+    :type path_to_trec: str
+
+    :param output_path: name of the binary file to write
+    :type output_path: str
+
+    :param compress: zlib compress the arrays
+    :type compress: bool
+
+    :rtype: None
+    :returns: Nothing
+    """
+    run = {}
+    score_texts = []
+    run_name = ''
+    with open(path_to_trec, 'r') as f:
+        for line in f:
+            split_line = line.split()
+            if not split_line:
+                continue
+            run_name = split_line[5] if len(split_line) > 5 else run_name
+            score_texts.append(split_line[4])
+            run.setdefault(split_line[0], []).append((split_line[2], float(split_line[4])))
+    writeBinaryRun(run, output_path, run_name=run_name, compress=compress, score_texts=score_texts)
+
+
+def binaryToTrec(path_to_run, output_path, run_name=None):
+    """
+    Exports a binary run to the trec-style format written by processor.writeRelevanceFile (e.g. for trec_eval)
+
+    :param path_to_run: the path to the binary run
+    :type path_to_run: str
+
+    :param output_path: name of the trec-style file to write
+    :type output_path: str
+
+    :param run_name: name of the run, default is the name stored in the binary run
+    :type run_name: str
+
+    :rtype: None
+    :returns: Nothing
+    """
+    run = loadBinaryRun(path_to_run)
+    run_name = run.run_name if run_name is None else run_name
+    with open(output_path, 'w') as f:
+        for topic in run:
+            codes, _ = run.topicArrays(topic)
+            f.writelines(topic + ' Q0 ' + run.docids[code] + ' ' + str(i+1) + ' ' + score + ' ' + run_name + '\n'
+                         for i, (code, score) in enumerate(zip(codes.tolist(), run.scoreTexts(topic))))
@@ -1,5 +1,7 @@
 import processor
+import profiler
 
+@profiler.timed('semanticSearch')
 def semanticSearch(model, topics, index, idx_to_docid, k=1000):
     """
     Performs semantic similarity search over the corpus
@@ -23,28 +25,58 @@ def semanticSearch(model, topics, index, idx_to_docid, k=1000):
     :returns: dictionary where the keys are the topics and the values are sorted (docid, score) run lists
 
     """
-    run = {}
     topic_nums = [topic for topic in topics]
     queries = [topics[topic]['title'] for topic in topics]
     encoded_queries = model.encode(queries)
+    profiler.count('queries_encoded', len(queries))
+    return vectorSearch(topic_nums, encoded_queries, index, idx_to_docid, k=k)
+
+
+def vectorSearch(topic_nums, encoded_queries, index, idx_to_docid, k=1000):
+    """
+    Knn search for already encoded queries, all topics in a single knn_query call
+
+    :param topic_nums: the topic of each query vector
+    :type topic_nums: list of str
+
+    :param encoded_queries: one query vector per topic
+    :type encoded_queries: np.array
+
+    :param index: the hnswlib knn index
+    :type index: hnswlib.Index
+
+    :param idx_to_docid: map from hnswlib index output to doc id
+    :type idx_to_docid: array
+
+    :param k: number of neighbors to retrieve
+    :type k: int
+
+    :rtype: dict
+    :returns: dictionary where the keys are the topics and the values are sorted (docid, score) run lists
+    """
+    run = {}
     labels, distances = index.knn_query(encoded_queries, k=k)
+    profiler.count('queries', len(topic_nums))
+    profiler.count('knn_calls')
     for i,topic in enumerate(topic_nums):
         run[topic] = []
         # considers highest passage match only for a document
-        added_docids = []
+        added_docids = set()
         sim = [1-x for x in distances[i]]
         scored_run = zip(labels[i], sim)
-        for i, (passageidx, dist) in enumerate(scored_run):
+        for passageidx, dist in scored_run:
             docid = idx_to_docid[passageidx]
             
             if docid not in added_docids:
                 run[topic].append((docid, dist))
-                added_docids.append(docid)
+                added_docids.add(docid)
         run[topic] = run[topic][:1000]
+        profiler.count('docs_scored', len(run[topic]))
     return run
 
 
-def bm25Search(pyserini_searcher, topics, k1=3.2, b=0.15):
+@profiler.timed('bm25Search')
+def bm25Search(pyserini_searcher, topics, k1=3.2, b=0.15, threads=1):
     """
     Performs BM25 search over the corpus
 
@@ -57,19 +89,32 @@ def bm25Search(pyserini_searcher, topics, k1=3.2, b=0.15):
     :param k1: BM25 parameter, optimized using last year's runs (default=3.2)
     :param b: BM25 parameter, optimized using last year's runs (default=0.15)
 
+    :param threads: if more than 1, all topics are searched in one multi-threaded batch_search call
+    :type threads: int
+
     :rtype: dict
     :returns: dictionary where the keys are the topics and the values are sorted (docid, score) run lists
     """
     
     pyserini_searcher.set_bm25(k1=k1, b=b)
     run = {}
+    if threads > 1:
+        topic_nums = [topic for topic in topics]
+        queries = [topics[topic]['title'] for topic in topics]
+        batch_hits = pyserini_searcher.batch_search(queries, topic_nums, k=1000, threads=threads)
     for i,topic in enumerate(topics):
         run[topic] = []
-        query = topics[topic]['title']
-        hits = pyserini_searcher.search(query, k=1000)
+        if threads > 1:
+            hits = batch_hits[topic]
+        else:
+            query = topics[topic]['title']
+            hits = pyserini_searcher.search(query, k=1000)
         # Sometimes, duplicate IDs get added, so this avoids adding duplicates
-        # Can be significantly optimized
+        added_docids = set()
         for i in range(len(hits)):
-            if hits[i].docid not in [x[0] for x in run[topic]]:
+            if hits[i].docid not in added_docids:
                 run[topic].append((hits[i].docid, hits[i].score))
+                added_docids.add(hits[i].docid)
+        profiler.count('queries')
+        profiler.count('docs_scored', len(run[topic]))
     return run
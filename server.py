@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import pickle
+import asyncio
+import argparse
+import collections
+import http.client
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import searcher
+import reranker
+import docstore
+
+class OpStats:
+    """
+    Throughput and latency counters for a single request handler
+    """
+
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.batches = 0
+        # items that went through the micro-batcher, including those submitted by fused/manifold
+        self.batched_items = 0
+        self.errors = 0
+        # only the most recent latencies are kept for the percentiles
+        self.latencies = collections.deque(maxlen=window)
+
+    def record(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+
+    def summary(self, uptime):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0.0
+        return {'requests': self.requests,
+                'batches': self.batches,
+                'errors': self.errors,
+                'mean_batch_size': self.batched_items / self.batches if self.batches else 0.0,
+                'requests_per_second': self.requests / uptime if uptime else 0.0,
+                'latency_ms_mean': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+                'latency_ms_p50': percentile(0.5),
+                'latency_ms_p95': percentile(0.95)}
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for up to max_wait seconds (or max_batch requests)
+    and hands them to handler as one list, so they share a single encode/knn_query/batch_search call.
+    The handler runs on a single worker thread, so the models are never used concurrently.
+    Other work on the same models must be submitted to the same executor.
+    """
+
+    def __init__(self, handler, stats, max_batch=64, max_wait=0.005, executor=None):
+        self.handler = handler
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.task = asyncio.ensure_future(self.loop())
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def loop(self):
+        event_loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = event_loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - event_loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.stats.batches += 1
+            self.stats.batched_items += len(batch)
+            try:
+                results = await event_loop.run_in_executor(self.executor, self.handler, [item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+class RetrievalService:
+    """
+    Holds the loaded searcher, index, lookups and models, and answers requests for
+    bm25, semantic, fused (interpolated) and manifold reranked retrieval
+    """
+
+    def __init__(self, pyserini_searcher, model, index, idx_to_docid, docid_to_doc, bm25_threads=8, max_batch=64, max_wait=0.005):
+        self.pyserini_searcher = pyserini_searcher
+        self.model = model
+        self.index = index
+        self.idx_to_docid = idx_to_docid
+        self.docid_to_doc = docid_to_doc
+        self.bm25_threads = bm25_threads
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.started = time.time()
+        self.stats = {op: OpStats() for op in ['bm25', 'semantic', 'fused', 'manifold', 'interpolate']}
+        # the one thread that uses the semantic model and index (semantic batches and manifold reranks)
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+
+    def startBatchers(self):
+        """
+        Creates the micro-batchers, must be called from inside the running event loop
+        """
+        self.bm25_batcher = MicroBatcher(self.bm25Batch, self.stats['bm25'], self.max_batch, self.max_wait)
+        self.semantic_batcher = MicroBatcher(self.semanticBatch, self.stats['semantic'], self.max_batch, self.max_wait, executor=self.model_executor)
+
+    @staticmethod
+    def batchTopics(queries):
+        """
+        Turns a batch of query strings into the topics dict the searcher methods expect
+        """
+        return {str(i): {'title': query} for i, query in enumerate(queries)}
+
+    def bm25Batch(self, items):
+        topics = self.batchTopics([item['query'] for item in items])
+        run = searcher.bm25Search(self.pyserini_searcher, topics, threads=self.bm25_threads)
+        return [run[str(i)][:item.get('k', 1000)] for i, item in enumerate(items)]
+
+    def semanticBatch(self, items):
+        topics = self.batchTopics([item['query'] for item in items])
+        k = max(item.get('k', 1000) for item in items)
+        run = searcher.semanticSearch(self.model, topics, self.index, self.idx_to_docid, k=k)
+        return [run[str(i)][:item.get('k', 1000)] for i, item in enumerate(items)]
+
+    @staticmethod
+    def validate(request):
+        """
+        Rejects a malformed request before it joins a micro-batch, where it would fail the whole batch
+        """
+        if not isinstance(request.get('query'), str):
+            raise ValueError('request needs a query string')
+        if not isinstance(request.get('k', 1000), int) or request.get('k', 1000) < 1:
+            raise ValueError('k must be a positive integer')
+
+    async def bm25(self, request):
+        self.validate(request)
+        return await self.bm25_batcher.submit(request)
+
+    async def semantic(self, request):
+        self.validate(request)
+        return await self.semantic_batcher.submit(request)
+
+    async def fused(self, request):
+        self.validate(request)
+        # both lists at full depth, k only truncates the interpolated run
+        full_request = dict(request, k=1000)
+        bm25_run, semantic_run = await asyncio.gather(self.bm25_batcher.submit(full_request), self.semantic_batcher.submit(full_request))
+        run = reranker.interpolateRuns({'q': bm25_run}, {'q': semantic_run}, request.get('alpha', 0.7))
+        return run['q'][:request.get('k', 1000)]
+
+    async def interpolate(self, request):
+        run = reranker.interpolateRuns({'q': request['run1']}, {'q': request['run2']}, request.get('alpha', 0.7))
+        return run['q']
+
+    async def manifold(self, request):
+        # rerank the given run, or the fused run for the query if none is given
+        self.validate(request)
+        run = request.get('run') or await self.fused(request)
+        topics = {'q': {'title': request['query']}}
+        event_loop = asyncio.get_running_loop()
+        reranked = await event_loop.run_in_executor(self.model_executor, lambda: reranker.manifoldRerank(
+            {'q': run}, self.model, topics, self.index, self.idx_to_docid, self.docid_to_doc,
+            rel_docs=request.get('rel_docs', 3), k=request.get('knn', 50), rerank_cutoff=request.get('rerank_cutoff')))
+        return reranked['q'][:request.get('k', 1000)]
+
+    def summary(self):
+        uptime = time.time() - self.started
+        stats = {op: self.stats[op].summary(uptime) for op in self.stats}
+        stats['uptime_seconds'] = uptime
+        return stats
+
+    async def handle(self, op, request):
+        """
+        Dispatches a request and records its latency
+
+        :param op: one of 'bm25', 'semantic', 'fused', 'interpolate', 'manifold' or 'stats'
+        :type op: str
+
+        :param request: the decoded json request body
+        :type request: dict
+
+        :rtype: object
+        :returns: the json serializable response
+        """
+        if op == 'stats':
+            return self.summary()
+        if op not in self.stats:
+            raise KeyError('unknown operation: ' + op)
+        start = time.time()
+        try:
+            result = await getattr(self, op)(request)
+        except Exception:
+            self.stats[op].errors += 1
+            raise
+        self.stats[op].record(time.time() - start)
+        return [(docid, float(score)) for docid, score in result]
+
+
+async def writeResponse(writer, status, payload, close=False):
+    """
+    Writes one HTTP/1.1 response with a json payload
+    """
+    payload = payload.encode()
+    writer.write(('HTTP/1.1 ' + status + '\r\nContent-Type: application/json\r\nContent-Length: ' + str(len(payload)) +
+                  ('\r\nConnection: close' if close else '') + '\r\n\r\n').encode() + payload)
+    await writer.drain()
+
+
+async def handleConnection(service, reader, writer):
+    """
+    Minimal HTTP/1.1 handler: POST /<op> with a json body, or GET /stats.
+    Connections are kept alive so clients can reuse them.
+    A malformed request gets a 400 and closes the connection, since the stream cannot be framed after it.
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode().split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+            except ValueError as e:
+                await writeResponse(writer, '400 Bad Request', json.dumps({'error': repr(e)}), close=True)
+                break
+            try:
+                result = await service.handle(path.strip('/'), json.loads(body) if body else {})
+                status, payload = '200 OK', json.dumps(result)
+            except Exception as e:
+                status, payload = '400 Bad Request', json.dumps({'error': repr(e)})
+            await writeResponse(writer, status, payload)
+    except (ConnectionResetError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service, unix_socket=None, host='127.0.0.1', port=8765):
+    """
+    Runs the service until cancelled, on a unix socket if given, otherwise on host:port
+
+    :param service: the loaded retrieval service
+    :type service: RetrievalService
+
+    :rtype: None
+    :returns: Nothing
+    """
+    service.startBatchers()
+    handler = lambda reader, writer: handleConnection(service, reader, writer)
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+        print('serving on', unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        print('serving on', host + ':' + str(port))
+    async with server:
+        await server.serve_forever()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class RetrievalClient:
+    """
+    Small blocking client for the retrieval service, e.g. for the visualizer or notebooks
+    """
+
+    def __init__(self, unix_socket=None, host='127.0.0.1', port=8765):
+        if unix_socket:
+            self.connection = UnixHTTPConnection(unix_socket)
+        else:
+            self.connection = http.client.HTTPConnection(host, port)
+
+    def request(self, op, **request):
+        body = json.dumps(request)
+        self.connection.request('POST', '/' + op, body, {'Content-Type': 'application/json'})
+        result = json.loads(self.connection.getresponse().read())
+        if isinstance(result, dict) and 'error' in result:
+            raise RuntimeError(result['error'])
+        return result
+
+    def bm25(self, query, k=1000):
+        return self.request('bm25', query=query, k=k)
+
+    def semantic(self, query, k=1000):
+        return self.request('semantic', query=query, k=k)
+
+    def fused(self, query, k=1000, alpha=0.7):
+        return self.request('fused', query=query, k=k, alpha=alpha)
+
+    def manifold(self, query, run=None, k=1000, rel_docs=3, knn=50, rerank_cutoff=None):
+        return self.request('manifold', query=query, run=run, k=k, rel_docs=rel_docs, knn=knn, rerank_cutoff=rerank_cutoff)
+
+    def stats(self):
+        return self.request('stats')
+
+
+def loadService(path_to_semantic_output, path_to_idx_output, model_name='msmarco-distilbert-base-v3', **kwargs):
+    """
+    Loads the same indices and models as main.py, once
+
+    :param path_to_semantic_output: directory where the semantic index data is saved
+    :type path_to_semantic_output: str
+
+    :param path_to_idx_output: path where the pyserini index is saved
+    :type path_to_idx_output: str
+
+    :rtype: RetrievalService
+    :returns: the loaded service
+    """
+    import hnswlib
+    from sentence_transformers import SentenceTransformer
+    from pyserini.search import SimpleSearcher
+
+    model = SentenceTransformer(model_name)
+    index = hnswlib.Index(space = 'cosine', dim=768)
+    index.load_index(path_to_semantic_output + 'passage.index')
+    index.set_ef(1100)
+    idx_to_docid = pickle.load(open(path_to_semantic_output + 'idx_to_passageid.p', 'rb'))
+    idx_to_passage = docstore.loadPassageStore(path_to_semantic_output + 'idx_to_passage')
+    docid_to_doc = docstore.LazyDocMap(idx_to_docid, idx_to_passage)
+    pyserini_searcher = SimpleSearcher(path_to_idx_output)
+    return RetrievalService(pyserini_searcher, model, index, idx_to_docid, docid_to_doc, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Long-lived local retrieval service')
+    parser.add_argument('--semantic', default='out/semantic/', help='semantic index directory')
+    parser.add_argument('--index', default='out/pyserini/index/', help='pyserini index directory')
+    parser.add_argument('--socket', default=None, help='unix socket path (default: tcp)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    service = loadService(args.semantic, args.index, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000)
+    asyncio.run(serve(service, unix_socket=args.socket, host=args.host, port=args.port))
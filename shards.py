@@ -0,0 +1,166 @@
+import os
+import json
+import heapq
+import pickle
+import itertools
+import hnswlib
+import numpy as np
+import docstore
+from concurrent.futures import ThreadPoolExecutor
+
+# Global labels are (shard slot << SLOT_SHIFT) | local label
+SLOT_SHIFT = 32
+LOCAL_MASK = (1 << SLOT_SHIFT) - 1
+
+class ShardDocids:
+    """
+    Maps the global labels returned by ShardedIndex.knn_query to docids,
+    through each shard's own local label -> docid table.
+    Can be passed anywhere idx_to_docid is expected.
+    """
+
+    def __init__(self, sharded_index):
+        self.sharded_index = sharded_index
+
+    def __getitem__(self, label):
+        label = int(label)
+        return self.sharded_index.shard_docids[label >> SLOT_SHIFT][label & LOCAL_MASK]
+
+    def __len__(self):
+        return sum(len(docids) for docids in self.sharded_index.shard_docids.values())
+
+
+class ShardedIndex:
+    """
+    Semantic index split into independent hnswlib shards (one per corpus file).
+    Queries fan out to all shards concurrently, and the per shard top-k are merged with a heap.
+    Shards are tracked in a manifest, so a shard can be added or rebuilt without touching the others.
+    """
+
+    def __init__(self, path_to_shards, dim=768, ef=1100, num_threads=None):
+        """
+        :param path_to_shards: directory holding the shards and the shards.json manifest
+        :type path_to_shards: str
+
+        :param dim: dimension of the passage vectors
+        :type dim: int
+
+        :param ef: hnswlib ef used for every shard
+        :type ef: int
+
+        :param num_threads: number of shards queried at the same time (default=number of cores)
+        :type num_threads: int
+        """
+        self.path_to_shards = path_to_shards
+        self.dim = dim
+        self.ef = ef
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.shards = {}
+        self.shard_docids = {}
+        self.docids = ShardDocids(self)
+
+        self.manifest = {'next_slot': 0, 'shards': {}}
+        if os.path.exists(self.manifestPath()):
+            with open(self.manifestPath(), 'r') as f:
+                self.manifest = json.load(f)
+        for name in self.manifest['shards']:
+            self.loadShard(name)
+
+    def manifestPath(self):
+        return os.path.join(self.path_to_shards, 'shards.json')
+
+    def loadShard(self, name):
+        """
+        Loads (or reloads) a single shard from disk
+
+        :param name: the shard name
+        :type name: str
+
+        :rtype: None
+        :returns: Nothing
+        """
+        slot = self.manifest['shards'][name]
+        index = hnswlib.Index(space = 'cosine', dim = self.dim)
+        index.load_index(os.path.join(self.path_to_shards, name + '.index'))
+        index.set_ef(self.ef)
+        self.shards[slot] = index
+        self.shard_docids[slot] = pickle.load(open(os.path.join(self.path_to_shards, name + '.docids.p'), 'rb'))
+
+    def registerShard(self, name):
+        """
+        Adds a shard that has been written to path_to_shards to the manifest and loads it.
+        If a shard of the same name exists, it is replaced and keeps its slot.
+
+        :param name: the shard name
+        :type name: str
+
+        :rtype: None
+        :returns: Nothing
+        """
+        if name not in self.manifest['shards']:
+            self.manifest['shards'][name] = self.manifest['next_slot']
+            self.manifest['next_slot'] += 1
+        with open(self.manifestPath(), 'w') as f:
+            json.dump(self.manifest, f)
+        self.loadShard(name)
+
+    def set_ef(self, ef):
+        self.ef = ef
+        for index in self.shards.values():
+            index.set_ef(ef)
+
+    def get_current_count(self):
+        return sum(index.get_current_count() for index in self.shards.values())
+
+    def queryShard(self, slot, queries, k):
+        """
+        knn search on a single shard, with the labels converted to global labels
+        """
+        index = self.shards[slot]
+        shard_k = min(k, index.get_current_count())
+        if shard_k == 0:
+            return np.empty((len(queries), 0), dtype=np.uint64), np.empty((len(queries), 0), dtype=np.float32)
+        labels, distances = index.knn_query(queries, k=shard_k, num_threads=1)
+        return labels.astype(np.uint64) | np.uint64(slot << SLOT_SHIFT), distances
+
+    def knn_query(self, queries, k=1):
+        """
+        Queries all shards concurrently and merges the per shard results
+
+        :param queries: query vectors
+        :type queries: np.array
+
+        :param k: number of neighbors to return
+        :type k: int
+
+        :rtype: tuple
+        :returns: (labels, distances) like hnswlib, labels are global labels (see docids)
+        """
+        queries = np.atleast_2d(queries)
+        with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            results = list(pool.map(lambda slot: self.queryShard(slot, queries, k), list(self.shards)))
+
+        k = min(k, sum(labels.shape[1] for labels, _ in results))
+        merged_labels = np.empty((len(queries), k), dtype=np.uint64)
+        merged_distances = np.empty((len(queries), k), dtype=np.float32)
+        for i in range(len(queries)):
+            # every shard's neighbors are already sorted by distance
+            merged = heapq.merge(*[zip(distances[i], labels[i]) for labels, distances in results])
+            for j, (distance, label) in enumerate(itertools.islice(merged, k)):
+                merged_labels[i, j] = label
+                merged_distances[i, j] = distance
+        return merged_labels, merged_distances
+
+    def passageLookups(self):
+        """
+        The docid and the on-disk text of every passage of every shard, used to build docid_to_doc
+
+        :rtype: tuple
+        :returns: (list of docids, docstore.ChainedPassageStore) in the same passage order
+        """
+        passage_docids = []
+        stores = []
+        for name in self.manifest['shards']:
+            passage_docids += self.shard_docids[self.manifest['shards'][name]]
+            stores.append(docstore.loadPassageStore(os.path.join(self.path_to_shards, name + '.passages')))
+        return passage_docids, docstore.ChainedPassageStore(stores)
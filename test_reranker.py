@@ -0,0 +1,43 @@
+import numpy as np
+import docblocks
+import reranker
+import processor
+
+def blocks(docids):
+    """
+    A block store with one passage vector per document
+    """
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(len(docids), 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return docblocks.DocumentBlocks(vectors, np.arange(len(docids) + 1, dtype=np.int64), docids)
+
+
+class FakeModel:
+    def encode(self, texts):
+        return np.random.default_rng(1).normal(size=(len(texts), 8)).astype(np.float32)
+
+
+def test_exactRerank_keeps_candidates_without_passages(tmp_path):
+    run = {'1': [('d1', 10.0), ('d2', 9.0), ('NOPASS', 8.0), ('d3', 7.0), ('d4', 6.0), ('d5', 5.0)]}
+    processor.writeRelevanceFile(run, str(tmp_path / 'run'), 'test')
+    reranked = reranker.exactRerank(str(tmp_path / 'run'), FakeModel(), {'1': {'title': 'q'}},
+                                    blocks(['d1', 'd2', 'd3', 'd4', 'd5']), rerank_cutoff=4)['1']
+
+    assert [docid for docid,_ in reranked][3:] == ['NOPASS', 'd4', 'd5']
+    assert sorted(docid for docid,_ in reranked[:3]) == ['d1', 'd2', 'd3']
+    scores = [score for _,score in reranked]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_exactManifoldCutoff_keeps_candidates_without_passages():
+    topic_run = [('d1', 10.0), ('d2', 9.0), ('NOPASS', 8.0), ('d3', 7.0), ('d4', 6.0)]
+    doc_blocks = blocks(['d1', 'd2', 'd3', 'd4'])
+    feedback_vectors = doc_blocks.feedbackVectors(['d1'])
+    distances = np.array([[0.0, 0.2, 0.4, 0.6]], dtype=np.float32)
+    reranked = reranker.exactManifoldCutoff(topic_run, feedback_vectors, distances, 4, 4, doc_blocks)
+
+    assert len(reranked) == len(topic_run)
+    assert [docid for docid,_ in reranked][3:] == ['NOPASS', 'd4']
+    scores = [score for _,score in reranked]
+    assert scores == sorted(scores, reverse=True)
@@ -0,0 +1,42 @@
+import numpy as np
+import runfile
+import reranker
+import processor
+
+def roundTrip(tmp_path, run, compress=False):
+    """
+    Writes the run as trec text, converts it to binary and back, and returns both texts
+    """
+    processor.writeRelevanceFile(run, str(tmp_path / 'run'), 'test')
+    runfile.trecToBinary(str(tmp_path / 'run'), str(tmp_path / 'run.bin'), compress=compress)
+    runfile.binaryToTrec(str(tmp_path / 'run.bin'), str(tmp_path / 'run.back'))
+    return (tmp_path / 'run').read_text(), (tmp_path / 'run.back').read_text()
+
+
+def test_integer_scores_round_trip(tmp_path):
+    # manifold document sums are counts
+    run = {'1': [('d1', 3), ('d2', 2), ('d3', 0)]}
+    text, back = roundTrip(tmp_path, run)
+    assert back == text
+    assert runfile.loadBinaryRun(str(tmp_path / 'run.bin')).score_format == 'int64'
+
+
+def test_mixed_scores_round_trip(tmp_path):
+    # cross encoder float32 scores, its 0 for docs without passages, and python floats
+    run = {'1': [('d1', np.float32(0.83891)), ('d2', 0.1234567890123), ('d3', 0)],
+           '2': [('d4', np.float32(-1e-05)), ('d5', 2)]}
+    for compress in [False, True]:
+        text, back = roundTrip(tmp_path, run, compress=compress)
+        assert back == text
+
+
+def test_loadRun_binary_is_lazy_and_matches_text(tmp_path):
+    run = {'1': [('d1', np.float32(0.83891)), ('d2', np.float32(0.5))], '2': [('d1', 2.5)]}
+    processor.writeRelevanceFile(run, str(tmp_path / 'run'), 'test')
+    processor.writeRelevanceFile(run, str(tmp_path / 'run.bin'), 'test', binary=True)
+    binary_run = reranker.loadRun(str(tmp_path / 'run.bin'))
+    assert isinstance(binary_run, runfile.BinaryRun)
+    assert isinstance(binary_run.codes, np.memmap) or isinstance(binary_run.codes.base, np.memmap)
+    assert dict(binary_run.items()) == reranker.loadRun(str(tmp_path / 'run'))
+    # built once per topic
+    assert binary_run['1'] is binary_run['1']
@@ -0,0 +1,263 @@
+import json
+import numpy as np
+
+class Timeline:
+    """
+    Step x document view of the visualizer history.
+    The rank of every document at every step is kept in one matrix, and prefix sums over the
+    steps (occurrence counts and rank sums) are built from it, so frequency and mean rank over any
+    [start, end) range of steps are O(docs) array differences instead of a walk over the history dicts.
+    Steps are appended with extend, and on the next query only the new steps are appended to the arrays,
+    which grow by doubling (in steps and in documents), so a query after every step costs O(docs) amortized per step.
+    """
+
+    def __init__(self, history=None, missing_rank=100):
+        """
+        :param history: Visualizer.history, list of {'dcg': .., 'docs': {docid: {'position': .., ..}}}
+        :type history: list of dict
+
+        :param missing_rank: rank given to a document at the steps it was not retrieved (the visualizer knn)
+        :type missing_rank: int
+        """
+        self.missing_rank = missing_rank
+        self.docids = []
+        self.docid_to_col = {}
+        # sparse (columns, ranks) of every step
+        self.step_cols = []
+        self.step_ranks = []
+        self.built_steps = 0
+        self.allocate(1, 1)
+        if history:
+            self.extend(history)
+
+    def __len__(self):
+        return len(self.step_cols)
+
+    def extend(self, history):
+        """
+        Appends history steps to the timeline
+
+        :param history: new history steps, in order
+        :type history: list of dict
+        """
+        for run in history:
+            cols = []
+            for docid in run['docs']:
+                if docid not in self.docid_to_col:
+                    self.docid_to_col[docid] = len(self.docids)
+                    self.docids.append(docid)
+                cols.append(self.docid_to_col[docid])
+            self.step_cols.append(np.array(cols, dtype=np.int64))
+            self.step_ranks.append(np.array([run['docs'][docid]['position'] for docid in run['docs']], dtype=np.int32))
+
+    def allocate(self, step_capacity, doc_capacity):
+        """
+        (Re)allocates the arrays with room for step_capacity steps and doc_capacity documents, keeping the built rows.
+        Unused cells hold the values of a document that was never retrieved.
+        """
+        # name -> (dtype, fill value, extra row for the prefix arrays)
+        layout = {'ranks': (np.int32, -1, 0),
+                  'count_prefix': (np.int32, 0, 1),
+                  'rank_prefix': (np.int64, 0, 1),
+                  'next_present': (np.int64, -1, 1),
+                  'prev_present': (np.int64, -1, 1),
+                  'streak': (np.int32, 0, 0)}
+        for name, (dtype, fill, extra) in layout.items():
+            array = np.full((step_capacity + extra, doc_capacity), fill, dtype=dtype)
+            if hasattr(self, '_' + name):
+                old = getattr(self, '_' + name)
+                array[:old.shape[0], :old.shape[1]] = old
+            setattr(self, '_' + name, array)
+
+    def build(self):
+        """
+        Appends the steps added since the last build to the rank matrix and the prefix arrays
+        """
+        n, d = len(self), len(self.docids)
+        if self.built_steps < n:
+            step_capacity, doc_capacity = self._ranks.shape
+            if n > step_capacity or d > doc_capacity:
+                self.allocate(max(n, 2 * step_capacity) if n > step_capacity else step_capacity,
+                              max(d, 2 * doc_capacity) if d > doc_capacity else doc_capacity)
+            for s in range(self.built_steps, n):
+                self.appendStep(s, self.step_cols[s], self.step_ranks[s])
+            self.built_steps = n
+
+        # views of the built part
+        self.ranks = self._ranks[:n, :d]
+        # prefix sums, row s covers the steps [0, s)
+        self.count_prefix = self._count_prefix[:n + 1, :d]
+        self.rank_prefix = self._rank_prefix[:n + 1, :d]
+        # next_present[s]: first step >= s the document is retrieved at (-1 if none yet)
+        # prev_present[s]: last step < s the document is retrieved at (-1 if none)
+        self.next_present = self._next_present[:n + 1, :d]
+        self.prev_present = self._prev_present[:n + 1, :d]
+        # streak[s]: number of consecutive steps the document has been retrieved, ending at s
+        self.streak = self._streak[:n, :d]
+
+    def appendStep(self, s, cols, ranks):
+        """
+        Fills row s of the arrays (and row s + 1 of the prefix arrays), every row before it is already built
+        """
+        self._ranks[s, cols] = ranks
+        self._count_prefix[s + 1] = self._count_prefix[s]
+        self._count_prefix[s + 1, cols] += 1
+        self._rank_prefix[s + 1] = self._rank_prefix[s]
+        self._rank_prefix[s + 1, cols] += ranks
+        # the steps since the previous appearance of a document now have their next appearance at s,
+        # every cell is filled once, so this is amortized O(1) per cell
+        previous = self._prev_present[s, cols]
+        for col, prev in zip(cols.tolist(), previous.tolist()):
+            self._next_present[prev + 1:s + 1, col] = s
+        self._prev_present[s + 1] = self._prev_present[s]
+        self._prev_present[s + 1, cols] = s
+        self._streak[s, cols] = self._streak[s - 1, cols] + 1 if s else 1
+
+    def bounds(self, start, end):
+        """
+        :rtype: tuple
+        :returns: start and end clipped like a slice of the history
+        """
+        start, end, _ = slice(start, end).indices(len(self))
+        return start, max(start, end)
+
+    def frequency(self, start, end):
+        """
+        :rtype: np.array
+        :returns: number of steps in [start, end) each document is retrieved at
+        """
+        self.build()
+        start, end = self.bounds(start, end)
+        return self.count_prefix[end] - self.count_prefix[start]
+
+    def meanRank(self, start, end, missing_rank=None):
+        """
+        Mean rank of every document over the steps [start, end)
+
+        :param missing_rank: rank counted at the steps a document is not retrieved,
+                             None averages over the steps it is retrieved at only (nan if never)
+        :type missing_rank: int
+
+        :rtype: np.array
+        :returns: mean rank per document
+        """
+        self.build()
+        start, end = self.bounds(start, end)
+        counts = self.count_prefix[end] - self.count_prefix[start]
+        rank_sums = (self.rank_prefix[end] - self.rank_prefix[start]).astype(np.float64)
+        if missing_rank is not None:
+            return (rank_sums + (end - start - counts) * missing_rank) / max(1, end - start)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, rank_sums / counts, np.nan)
+
+    def firstAppearance(self, start, end):
+        """
+        :rtype: np.array
+        :returns: first step in [start, end) each document is retrieved at, -1 if none
+        """
+        self.build()
+        start, end = self.bounds(start, end)
+        first = self.next_present[start]
+        return np.where((first >= 0) & (first < end), first, -1)
+
+    def lastAppearance(self, start, end):
+        """
+        :rtype: np.array
+        :returns: last step in [start, end) each document is retrieved at, -1 if none
+        """
+        self.build()
+        start, end = self.bounds(start, end)
+        last = self.prev_present[end]
+        return np.where(last >= start, last, -1)
+
+    def dwell(self, start, end):
+        """
+        Dwell time: the longest number of consecutive steps in [start, end) each document stays retrieved.
+        A streak running into start is only counted from start on.
+
+        :rtype: np.array
+        :returns: longest streak per document
+        """
+        self.build()
+        start, end = self.bounds(start, end)
+        if start == end:
+            return np.zeros(len(self.docids), dtype=np.int32)
+        clip = np.arange(1, end - start + 1, dtype=np.int32)[:, None]
+        return np.minimum(self.streak[start:end], clip).max(axis=0)
+
+    def freqDocs(self, start, end, topn=20):
+        """
+        The topn most frequent docs over the steps [start, end),
+        ties are ordered by first appearance in the range and then by rank
+
+        :rtype: list of str
+        :returns: docids
+        """
+        counts = self.frequency(start, end)
+        first = self.firstAppearance(start, end)
+        cols = np.nonzero(counts)[0]
+        first_rank = self.ranks[first[cols], cols]
+        order = np.lexsort((first_rank, first[cols], -counts[cols]))[:topn]
+        return [self.docids[col] for col in cols[order]]
+
+    def topDocs(self, idx, topn=20):
+        """
+        :rtype: list of str
+        :returns: the docids ranked above topn at step idx, in rank order
+        """
+        self.build()
+        ranks = self.ranks[idx]
+        cols = np.nonzero((ranks >= 0) & (ranks < topn))[0]
+        return [self.docids[col] for col in cols[np.argsort(ranks[cols], kind='stable')]]
+
+    def rankSeries(self, start, end, docs, missing_rank=None):
+        """
+        :rtype: np.array
+        :returns: steps x docs ranks over [start, end), missing_rank (default the timeline's) where not retrieved
+        """
+        self.build()
+        start, end = self.bounds(start, end)
+        missing_rank = self.missing_rank if missing_rank is None else missing_rank
+        series = np.full((end - start, len(docs)), missing_rank, dtype=np.int32)
+        for i, doc in enumerate(docs):
+            if doc in self.docid_to_col:
+                ranks = self.ranks[start:end, self.docid_to_col[doc]]
+                series[:, i] = np.where(ranks >= 0, ranks, missing_rank)
+        return series
+
+    def exportMeanRankAnimation(self, output_path, topn=100, window=None, labels=None):
+        """
+        Writes the frames of the mean rank animation (see animations/) as json:
+        for every step, the topn documents by mean rank over the preceding steps, missing steps counted as missing_rank.
+        Each frame is one prefix array difference, the history is not scanned again.
+
+        :param output_path: name of the json file to write
+        :type output_path: str
+
+        :param topn: number of documents per frame
+        :type topn: int
+
+        :param window: number of preceding steps averaged, None for all steps since the start
+        :type window: int
+
+        :param labels: label of every step (e.g. Visualizer.transcript_time)
+        :type labels: list
+
+        :rtype: dict
+        :returns: the exported data
+        """
+        self.build()
+        frames = []
+        for s in range(len(self)):
+            start = 0 if window is None else max(0, s + 1 - window)
+            mean_rank = self.meanRank(start, s + 1, missing_rank=self.missing_rank)
+            seen = np.nonzero(self.count_prefix[s + 1] - self.count_prefix[start])[0]
+            top = seen[np.argsort(mean_rank[seen], kind='stable')[:topn]]
+            frames.append({'step': s,
+                           'label': labels[s] if labels is not None else s,
+                           'docs': [self.docids[col] for col in top],
+                           'mean_rank': mean_rank[top].tolist()})
+        data = {'topn': topn, 'window': window, 'missing_rank': self.missing_rank, 'frames': frames}
+        with open(output_path, 'w') as f:
+            json.dump(data, f)
+        return data
@@ -1,22 +1,29 @@
 import json
 import math
-from pyserini.search import SimpleSearcher
-import matplotlib.pyplot as plt
-from sentence_transformers import SentenceTransformer
+import timeline
 
 class Visualizer:
 
-    def __init__(self, out_dir, pyserini_index_path):
+    def __init__(self, out_dir, pyserini_index_path, searcher=None, encoder=None):
         """
-        Initializes the visualizer class
+        Initializes the visualizer class.
+        An already loaded searcher and encoder can be passed in to share them between visualizers (see batch.py)
         """
         self.out_dir = out_dir
 
-        self.searcher = SimpleSearcher(pyserini_index_path)
-        self.searcher.set_bm25(k1=3.2, b=0.15)
+        # pyserini (the JVM), sentence_transformers and matplotlib are imported where they are needed,
+        # so the history analytics (e.g. compareRuns in benchmark.py) work without the model stack
+        if searcher is None:
+            from pyserini.search import SimpleSearcher
+            searcher = SimpleSearcher(pyserini_index_path)
+            searcher.set_bm25(k1=3.2, b=0.15)
+        self.searcher = searcher
 
         # Semantic encoder model
-        self.encoder = SentenceTransformer('stsb-distilbert-base')
+        if encoder is None:
+            from sentence_transformers import SentenceTransformer
+            encoder = SentenceTransformer('stsb-distilbert-base')
+        self.encoder = encoder
 
         # Stores the transcript stream
         self.transcript = []
@@ -24,13 +31,19 @@ class Visualizer:
         
         # Stores historical calculations for future reference
         self.history = []
+        # (docid, score) hits of the recent transcript entries, each entry is searched once and reused while in the lookback
+        self.window_hits = {}
+        # Timeline analytics over the history, extended on demand by getTimeline
+        self.timeline_cache = None
 
         # The number of transcript entries to group when searching
         self.lookback = 5
         # The number of documents to return per search
         self.knn = 100
+        # The number of hits retrieved for each transcript entry
+        self.window_depth = 100
 
-    def addToTranscript(self, text, timestamp=None):
+    def addToTranscript(self, text, timestamp=None, hits=None):
         """
         Appends a new text window to the transcript. 
         Note that the addition is treated as a single temporal object for weighting
@@ -38,10 +51,16 @@ class Visualizer:
         :param text: string of transcript text (n most recent words)
         :type text: str
 
+        :param hits: (docid, score) hits of text with window_depth hits, if already searched (e.g. in a batch_search
+                     over many transcripts, see batch.py), otherwise text is searched with the searcher
+        :type hits: list
+
         :rtype: None
         :returns: None, but updates transcript with the new text
         """
         self.transcript.append(text)
+        if hits is not None:
+            self.window_hits[len(self.transcript) - 1] = hits
         if timestamp == None:
             self.transcript_time.append(len(self.transcript_time))
         else:
@@ -55,23 +74,28 @@ class Visualizer:
         
     def weightedWindowSearch(self, lookback=1, k=1, weight=None):
         # Collect the transcript windows based on the lookback
-        search_windows = self.transcript[-1 * lookback:]
+        first_window = max(0, len(self.transcript) - lookback)
+        search_windows = range(first_window, len(self.transcript))
         # Calculate the weights for each window
         if weight == 'uniform':
             search_window_weights = [1] * lookback
         elif weight == 'discount':
             search_window_weights = [1 / (lookback-i) for i in range(0, lookback)]
         run = {}
+        for window in [window for window in self.window_hits if window < first_window]:
+            del self.window_hits[window]
         for window, weight in zip(search_windows, search_window_weights):
-            hits = self.searcher.search(window, k=100)
-            for hit in hits:
-                if hit.docid not in run:
-                    run[hit.docid] = 0
-                run[hit.docid] += hit.score * weight
+            if window not in self.window_hits:
+                self.window_hits[window] = [(hit.docid, hit.score) for hit in self.searcher.search(self.transcript[window], k=self.window_depth)]
+            for docid, score in self.window_hits[window]:
+                if docid not in run:
+                    run[docid] = 0
+                run[docid] += score * weight
         sorted_run = sorted([(docid, run[docid]) for docid in run], reverse=True, key=lambda x: x[1])[:k]
         return sorted_run
 
-    def compareRuns(self, prev_run, cur_run):
+    @staticmethod
+    def compareRuns(prev_run, cur_run):
         """
         Compares the position of documents across two given runs.
         DCG, positional gain, score gain
@@ -85,39 +109,36 @@ class Visualizer:
 
         return cur_run
 
+    def getTimeline(self):
+        """
+        Returns the timeline analytics of the history, only the steps added since the last call are processed
+        """
+        if self.timeline_cache is None:
+            self.timeline_cache = timeline.Timeline(missing_rank=self.knn)
+        self.timeline_cache.extend(self.history[len(self.timeline_cache):])
+        return self.timeline_cache
+
     def findFreqDocs(self, start_idx, end_idx, topn=20):
         """
         Gets the topn most frequent docs over a given window
         """
-        doc_counts = {}
-        for run in self.history[start_idx:end_idx]:
-            for doc in run['docs']:
-                if doc not in doc_counts:
-                    doc_counts[doc] = 0
-                doc_counts[doc] += 1
-        sorted_doc_counts = sorted([(doc, doc_counts[doc]) for doc in doc_counts], reverse=True, key=lambda x: x[1])
-        return [doc[0] for doc in sorted_doc_counts][:topn]
+        return self.getTimeline().freqDocs(start_idx, end_idx, topn=topn)
         
 
     def getTopDocs(self, idx, topn=20):
         """
         Gets the topn docids for a given index
         """
-        docs = [docid for docid in self.history[idx]['docs'] if self.history[idx]['docs'][docid]['position'] < topn]
-        return docs
+        return self.getTimeline().topDocs(idx, topn=topn)
 
 
     def plotDocRankings(self, start_idx, end_idx, docs):
         """
         Plots the positions of the docis from the start_idx to the end_idx 
         """
-        docs = {doc: [] for doc in docs}
-        for i in range(start_idx, end_idx+1):
-            for doc in docs:
-                if doc in self.history[i]['docs']:
-                    docs[doc].append(self.history[i]['docs'][doc]['position'])
-                else:
-                    docs[doc].append(self.knn)
+        import matplotlib.pyplot as plt
+        series = self.getTimeline().rankSeries(start_idx, end_idx+1, docs, missing_rank=self.knn)
+        docs = {doc: series[:, i].tolist() for i, doc in enumerate(docs)}
 
         
         x = self.transcript_time[start_idx:end_idx+1]
@@ -139,6 +160,7 @@ class Visualizer:
         
 
         plt.savefig(self.out_dir + 'docrankingsplot_' + str(start_idx) + '_' + str(end_idx+1) + '.png')
+        plt.close(fig)
         
                     
 
@@ -211,37 +233,53 @@ class Visualizer:
             
         
 
-path_to_transcript = '../data/transcripts/debate.txt'
+def loadTranscript(path_to_transcript):
+    """
+    Loads a transcript file of alternating timestamp and text lines
+
+    :param path_to_transcript: path to the transcript
+    :type path_to_transcript: str
+
+    :rtype: tuple
+    :returns: (list of text segments, list of timestamps)
+    """
+    with open(path_to_transcript) as f:
+        content = [line.strip() for line in f]
+        text = []
+        time = []
+        for i in range(0, len(content) - 1, 2):
+            time.append(content[i])
+            text.append(content[i+1])
+    return text, time
+
+
+if __name__ == '__main__':
+    path_to_transcript = '../data/transcripts/debate.txt'
 
     
-x = Visualizer('out/visualization/', 'out/pyserini/index/')
-with open(path_to_transcript) as f:
-    content = [line.strip() for line in f]
-    text = []
-    time = []
-    for i in range(0, len(content), 2):
-        time.append(content[i])
-        text.append(content[i+1])
-
-start_idx = time.index('110:53')
+    x = Visualizer('out/visualization/', 'out/pyserini/index/')
+    text, time = loadTranscript(path_to_transcript)
+
+    start_idx = time.index('110:53')
         
-docs = []
-for i,(segment, timestamp) in enumerate(zip(text[start_idx: start_idx + 100], time[start_idx: start_idx + 100])):
-    print(i,segment)
-    x.addToTranscript(segment, timestamp=timestamp)
+    docs = []
+    for i,(segment, timestamp) in enumerate(zip(text[start_idx: start_idx + 100], time[start_idx: start_idx + 100])):
+        print(i,segment)
+        x.addToTranscript(segment, timestamp=timestamp)
     
-    #docs = list(set(docs + x.getTopDocs(i)))
-docs = x.findFreqDocs(0,99, topn=100)
-#docs = x.findDocsByKeyword(["bible god creationism", "heavens astronomy stars"], topn=5)
-print(docs)
-#docs = [docid for doc in docs for docid in doc[1]]
-with open(x.out_dir + 'docs.json', 'w') as f:
-    for doc in docs:
-        f.write(x.searcher.doc(doc).raw())
-#rankings = x.plotDocRankings(0, 100, docs)
-#rankings = x.plotDocRankings(100, 200, docs)
-#rankings = x.plotDocRankings(200, 300, docs)
-#rankings = x.plotDocRankings(300, 400, docs)
-#rankings = x.plotDocRankings(400, 499, docs)
-x.caterpillarEncode(0, 99, docs)
+        #docs = list(set(docs + x.getTopDocs(i)))
+    docs = x.findFreqDocs(0,99, topn=100)
+    x.getTimeline().exportMeanRankAnimation(x.out_dir + 'mean_rank_frames.json', topn=100, labels=x.transcript_time)
+    #docs = x.findDocsByKeyword(["bible god creationism", "heavens astronomy stars"], topn=5)
+    print(docs)
+    #docs = [docid for doc in docs for docid in doc[1]]
+    with open(x.out_dir + 'docs.json', 'w') as f:
+        for doc in docs:
+            f.write(x.searcher.doc(doc).raw())
+    #rankings = x.plotDocRankings(0, 100, docs)
+    #rankings = x.plotDocRankings(100, 200, docs)
+    #rankings = x.plotDocRankings(200, 300, docs)
+    #rankings = x.plotDocRankings(300, 400, docs)
+    #rankings = x.plotDocRankings(400, 499, docs)
+    x.caterpillarEncode(0, 99, docs)
 